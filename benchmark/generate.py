@@ -0,0 +1,160 @@
+'''Seeded synthetic MAVEN-Arg data for benchmarking ``evaluate.py``.
+
+Writes a CodaLab style input directory::
+
+    OUT/ref/label2role.json        schema, event type -> roles
+    OUT/ref/test.unified.jsonl     gold documents in the unified format
+    OUT/res/test_prediction.jsonl  noisy predictions for them
+
+so that ``python evaluate.py OUT OUT/scores`` scores it directly. Every count
+is drawn around the configured mean and the same seed always gives the same
+files.
+
+    python benchmark/generate.py OUT --docs 1000 --seed 0
+'''
+import os
+import json
+import random
+import argparse
+from dataclasses import dataclass, asdict
+
+
+WORDS = ("the", "a", "an", "army", "city", "river", "storm", "council", "police", "troops", "village",
+         "bridge", "king", "president", "company", "ship", "fire", "hospital", "election", "treaty",
+         "North", "South", "New", "United", "St.", "U.S.", "1945", "three", "dozens", "of", "in",
+         "at", "and", "near", "after", "Smith's", "workers,", "(reported)", "officials;", "county")
+ROLES = ("Agent", "Patient", "Location", "Time", "Instrument", "Content", "Cause", "Purpose",
+         "Recipient", "Destination", "Source", "Manner")
+
+
+@dataclass
+class SyntheticConfig:
+    '''Scale and noise of a synthetic data set; counts are per-item means.'''
+    docs: int = 100
+    words_per_doc: int = 400
+    event_types: int = 40
+    events_per_doc: float = 6.0
+    triggers_per_event: float = 1.5
+    entities_per_role: float = 1.2
+    mentions_per_entity: float = 1.8
+    non_entity_rate: float = 0.2
+    negative_trigger_rate: float = 0.5
+    noise: float = 0.3
+    seed: int = 0
+
+
+def draw(rnd, mean, minimum=0):
+    # integer around ``mean``: uniform on [minimum, 2 * mean - minimum]
+    high = max(minimum, int(round(2 * mean - minimum)))
+    return rnd.randint(minimum, high)
+
+
+def generate_schema(config, rnd):
+    return {f"Type{i:03d}": sorted(rnd.sample(ROLES, rnd.randint(1, 6)), key=ROLES.index)
+            for i in range(config.event_types)}
+
+
+def generate_document(config, rnd, doc_idx, schema):
+    '''Return the gold document and its prediction entry.'''
+    words = [rnd.choice(WORDS) for _ in range(config.words_per_doc)]
+    offsets, position = [], 0
+    for word in words:
+        offsets.append((position, position + len(word)))
+        position += len(word) + 1
+    text = " ".join(words)
+
+    def span(length=None):
+        length = length or rnd.randint(1, 4)
+        start = rnd.randrange(len(words) - length)
+        return [offsets[start][0], offsets[start + length - 1][1]]
+
+    def noisy(position):
+        # shift one boundary by a word, or replace the span altogether
+        if rnd.random() < 0.5:
+            return span()
+        start = max(0, position[0] - rnd.choice((0, 4, 8)))
+        end = min(len(text), position[1] + rnd.choice((0, 5, 9)))
+        return [start, end]
+
+    doc_id = f"DOC{doc_idx:06d}"
+    events, preds, n_triggers = [], {}, 0
+    for event_idx in range(draw(rnd, config.events_per_doc)):
+        event_type = rnd.choice(list(schema))
+        arguments = []
+        for role in schema[event_type]:
+            for _ in range(draw(rnd, config.entities_per_role)):
+                non_entity = rnd.random() < config.non_entity_rate
+                arguments.append({
+                    "id": f"non-entity-{len(arguments)}" if non_entity else f"ENTITY_{doc_idx}_{len(arguments)}",
+                    "role": f"{event_type}.{role}",
+                    "mentions": [{"position": span()}
+                                 for _ in range(1 if non_entity else draw(rnd, config.mentions_per_entity, 1))],
+                })
+        triggers = []
+        for trigger_idx in range(draw(rnd, config.triggers_per_event, 1)):
+            trigger_id = f"{doc_id}E{event_idx}T{trigger_idx}"
+            position = span(1)
+            triggers.append({"id": trigger_id, "trigger_word": text[position[0]:position[1]],
+                             "position": position, "arguments": arguments})
+            n_triggers += 1
+            if rnd.random() < config.noise / 3:
+                continue  # missed trigger
+            predicted_type = rnd.choice(list(schema)) if rnd.random() < config.noise / 3 else event_type
+            pred = {"event_type": predicted_type}
+            for role in schema[predicted_type]:
+                gold = [mention["position"] for argument in arguments if argument["role"] == f"{predicted_type}.{role}"
+                        for mention in argument["mentions"]]
+                spans = [noisy(position) if rnd.random() < config.noise else position
+                         for position in gold if rnd.random() >= config.noise / 2]
+                spans += [span() for _ in range(draw(rnd, config.noise))]
+                if spans:
+                    pred[role] = [text[start:end] for start, end in spans]
+            preds[trigger_id] = pred
+        events.append({"id": f"EVENT_{doc_idx}_{event_idx}", "type": event_type, "triggers": triggers})
+
+    negative_triggers = []
+    for negative_idx in range(draw(rnd, config.negative_trigger_rate * n_triggers)):
+        trigger_id = f"{doc_id}N{negative_idx}"
+        position = span(1)
+        negative_triggers.append({"id": trigger_id, "trigger_word": text[position[0]:position[1]],
+                                  "position": position})
+        if rnd.random() < config.noise:
+            # false positive trigger
+            event_type = rnd.choice(list(schema))
+            preds[trigger_id] = {"event_type": event_type,
+                                 **{role: [text[slice(*span())]] for role in schema[event_type][:2]}}
+    gold = {"id": doc_id, "title": f"Synthetic document {doc_idx}", "text": text, "events": events,
+            "negative_triggers": negative_triggers}
+    return gold, {"id": doc_id, "preds": preds}
+
+
+def generate(out_dir, config):
+    '''Write the schema, gold and predictions of ``config`` under ``out_dir``.'''
+    rnd = random.Random(config.seed)
+    schema = generate_schema(config, rnd)
+    os.makedirs(os.path.join(out_dir, "ref"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "res"), exist_ok=True)
+    with open(os.path.join(out_dir, "ref", "label2role.json"), "w") as f:
+        json.dump(schema, f, indent=1)
+    with open(os.path.join(out_dir, "ref", "test.unified.jsonl"), "w") as gold_file, \
+            open(os.path.join(out_dir, "res", "test_prediction.jsonl"), "w") as pred_file:
+        for doc_idx in range(config.docs):
+            gold, pred = generate_document(config, rnd, doc_idx, schema)
+            gold_file.write(json.dumps(gold) + "\n")
+            pred_file.write(json.dumps(pred) + "\n")
+    with open(os.path.join(out_dir, "config.json"), "w") as f:
+        json.dump(asdict(config), f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic MAVEN-Arg gold and predictions.")
+    parser.add_argument("out_dir")
+    for name, default in asdict(SyntheticConfig()).items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = vars(parser.parse_args(argv))
+    out_dir = args.pop("out_dir")
+    generate(out_dir, SyntheticConfig(**args))
+
+
+if __name__ == "__main__":
+    main()
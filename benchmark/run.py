@@ -0,0 +1,229 @@
+'''Benchmark the scorer on synthetic data and compare against stored baselines.
+
+For every scale, a seeded data set is generated with ``generate.py``. The
+harness then times the loaders, ``find_optimal_match`` and the metric
+functions, and reports their throughput and peak traced memory. Each
+benchmark is compared against ``baselines.json``. A run is a regression when
+it is slower or uses more memory than ``--tolerance`` times the baseline,
+or when its scores differ from the baseline scores. The exit code is 1 if
+any regression is found.
+
+    python benchmark/run.py                       # small, medium and coref scales
+    python benchmark/run.py --scales large --repeat 1
+    python benchmark/run.py --update-baselines    # record this machine's numbers
+
+Baselines are machine dependent: record them on the machine that runs the
+comparison.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from dataclasses import asdict, replace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import evaluate  # noqa: E402
+from generate import SyntheticConfig, generate  # noqa: E402
+
+
+SCALES = {
+    "small": SyntheticConfig(docs=100),
+    "medium": SyntheticConfig(docs=1000),
+    "large": SyntheticConfig(docs=5000),
+    "coref": SyntheticConfig(docs=100, triggers_per_event=5.0, entities_per_role=2.0, mentions_per_entity=3.0),
+}
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+# find_optimal_match is timed on at most this many (trigger, role) cases
+MATCH_SAMPLE = 5000
+
+
+class BenchmarkData:
+    '''Paths of a generated data set and the inputs shared by the benchmarks.'''
+
+    def __init__(self, data_dir, config):
+        self.config = config
+        self.test_file = os.path.join(data_dir, "ref", "test.unified.jsonl")
+        self.schema_file = os.path.join(data_dir, "ref", "label2role.json")
+        self.pred_file = os.path.join(data_dir, "res", "test_prediction.jsonl")
+        with open(self.schema_file) as f:
+            self.schema = json.load(f)
+        self.label_id2spans, self.pred_id2spans, self.all_triggers = \
+            evaluate.get_pred_label_spans(self.pred_file, self.test_file)
+        self.match_cases = []
+        for id, label in self.label_id2spans.items():
+            pred = self.pred_id2spans.get(id)
+            if pred is not None and pred["spans"]:
+                self.match_cases.append(([span for spans in evaluate.get_span_tokens(label) for span in spans],
+                                         evaluate.get_span_tokens(pred)))
+                if len(self.match_cases) == MATCH_SAMPLE:
+                    break
+
+
+def bench_get_pred_label_spans(data):
+    evaluate.get_pred_label_spans(data.pred_file, data.test_file)
+    return data.config.docs, "docs"
+
+
+def bench_load_indexed(data):
+    gold = evaluate.load_gold(data.test_file, data.schema)
+    evaluate.load_predictions(data.pred_file, gold)
+    return data.config.docs, "docs"
+
+
+def bench_find_optimal_match(data):
+    for gold_spans, pred_spans in data.match_cases:
+        evaluate.find_optimal_match(gold_spans, pred_spans)
+    return len(data.match_cases), "matches"
+
+
+def bench_level(function):
+    def bench(data):
+        function(data.label_id2spans, data.pred_id2spans, data.all_triggers, data.schema)
+        return data.config.docs, "docs"
+    return bench
+
+
+def bench_compute_metrics(data):
+    gold = evaluate.load_gold(data.test_file, data.schema)
+    evaluate.compute_metrics(gold, evaluate.load_predictions(data.pred_file, gold))
+    return data.config.docs, "docs"
+
+
+BENCHMARKS = {
+    "get_pred_label_spans": bench_get_pred_label_spans,
+    "load_indexed": bench_load_indexed,
+    "find_optimal_match": bench_find_optimal_match,
+    "compute_mention_level_F1": bench_level(evaluate.compute_mention_level_F1),
+    "compute_entity_coref_level_F1": bench_level(evaluate.compute_entity_coref_level_F1),
+    "compute_event_entity_coref_level_F1": bench_level(evaluate.compute_event_entity_coref_level_F1),
+    "end_to_end": bench_compute_metrics,
+}
+
+
+def measure(benchmark, data, repeat):
+    '''Best wall time of ``repeat`` runs, then peak traced memory of one more.'''
+    seconds = []
+    for _ in range(repeat):
+        evaluate.tokenize_span.cache_clear()
+        started = time.perf_counter()
+        units, unit = benchmark(data)
+        seconds.append(time.perf_counter() - started)
+    evaluate.tokenize_span.cache_clear()
+    tracemalloc.start()
+    try:
+        benchmark(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = min(seconds)
+    return {"seconds": best, "throughput": units / best if best else float("inf"), "unit": unit,
+            "peak_mb": peak / (1 << 20)}
+
+
+def reference_scores(data):
+    gold = evaluate.load_gold(data.test_file, data.schema)
+    metrics = evaluate.compute_metrics(gold, evaluate.load_predictions(data.pred_file, gold))
+    return {level + "_" + metric: value for level, scores in metrics.items() for metric, value in scores.items()}
+
+
+def prepare(scale, config, data_root):
+    data_dir = os.path.join(data_root, scale)
+    config_file = os.path.join(data_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            if json.load(f) == asdict(config):
+                return data_dir
+    generate(data_dir, config)
+    return data_dir
+
+
+def compare(result, baseline, tolerance):
+    '''Return the time and memory ratios to the baseline and whether either regressed.'''
+    if baseline is None:
+        return None, None, False
+    time_ratio = result["seconds"] / baseline["seconds"] if baseline["seconds"] else 1.0
+    memory_ratio = result["peak_mb"] / baseline["peak_mb"] if baseline["peak_mb"] else 1.0
+    return time_ratio, memory_ratio, time_ratio > tolerance or memory_ratio > tolerance
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark evaluate.py on synthetic MAVEN-Arg data.")
+    parser.add_argument("--scales", default="small,medium,coref", help="comma separated subset of " + ",".join(SCALES))
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="comma separated subset of benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark; the best one counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="directory to keep the generated data sets in (default: a temp dir)")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--update-baselines", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="slowdown or memory growth factor reported as a regression")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    scales = args.scales.split(",")
+    benchmarks = args.benchmarks.split(",")
+    for name in scales:
+        if name not in SCALES:
+            parser.error(f"unknown scale {name}")
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f).get("results", {})
+    data_root = args.data_dir or tempfile.mkdtemp(prefix="maven-arg-bench-")
+    results, regressions = {}, []
+    print(f"{'scale':8} {'benchmark':38} {'seconds':>9} {'throughput':>21} {'peak MB':>9} {'time':>7} {'memory':>7}")
+    for scale in scales:
+        config = replace(SCALES[scale], seed=args.seed)
+        data = BenchmarkData(prepare(scale, config, data_root), config)
+        scale_baselines = baselines.get(scale, {})
+        results[scale] = {"config": asdict(config), "scores": reference_scores(data), "benchmarks": {}}
+        baseline_scores = scale_baselines.get("scores")
+        if baseline_scores is not None and scale_baselines.get("config") == asdict(config):
+            for key, value in results[scale]["scores"].items():
+                if not np.isclose(value, baseline_scores[key], rtol=0, atol=1e-9, equal_nan=True):
+                    regressions.append(f"{scale} {key}: score {value!r} != baseline {baseline_scores[key]!r}")
+        for name in benchmarks:
+            result = measure(BENCHMARKS[name], data, args.repeat)
+            results[scale]["benchmarks"][name] = result
+            time_ratio, memory_ratio, regressed = compare(
+                result, scale_baselines.get("benchmarks", {}).get(name), args.tolerance)
+            if regressed:
+                regressions.append(f"{scale} {name}: {time_ratio:.2f}x time, {memory_ratio:.2f}x memory")
+            ratios = "" if time_ratio is None else f" {time_ratio:6.2f}x {memory_ratio:6.2f}x"
+            print(f"{scale:8} {name:38} {result['seconds']:9.3f} "
+                  f"{result['throughput']:11.0f} {result['unit'] + '/s':9} {result['peak_mb']:9.1f}{ratios}"
+                  + ("  REGRESSION" if regressed else ""))
+
+    report = {"machine": {"python": platform.python_version(), "numpy": np.__version__,
+                          "platform": platform.platform(), "processor": platform.processor()},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.update_baselines:
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as f:
+                stored = json.load(f)
+            stored["results"].update(results)
+            report["results"] = stored["results"]
+        with open(args.baselines, "w") as f:
+            json.dump(report, f, indent=1)
+            f.write("\n")
+        print(f"baselines written to {args.baselines}")
+        return 0
+    for regression in regressions:
+        print("regression: " + regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
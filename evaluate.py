@@ -15,82 +15,186 @@
 
 # Some libraries and options
 import os
-from sys import argv
+import mmap
+import struct
+import hashlib
+import argparse
+import sys
+from sys import stderr
 import json
-import yaml
 import re
-import copy
 import json
+import math
 import string
-import numpy as np
-from collections import Counter, defaultdict
-from scipy.optimize import linear_sum_assignment
+import itertools
+import multiprocessing
+import time
+import importlib
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from array import array
+from bisect import bisect_left, bisect_right
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 
+class LazyModule:
+    '''Module imported on first attribute access, which then replaces this
+       stand-in under ``alias`` in the module globals. Keeps ``import evaluate``
+       fast when only the CLI parser or the ``Scorer`` class is needed; scipy and
+       yaml are imported in the functions using them for the same reason.
+    '''
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+np = LazyModule("numpy", "np")
+
+# Optional faster JSON parsers, tried in this order when no backend is given.
+JSON_BACKENDS = ("orjson", "ujson", "json")
+
+
+def get_json_loads(backend=None):
+    '''Return the ``loads`` function of a JSON backend.
+       ``backend`` is one of ``JSON_BACKENDS``; ``None`` picks the fastest installed one.
+    '''
+    candidates = JSON_BACKENDS if backend is None else (backend,)
+    for name in candidates:
+        if name == "json":
+            return json.loads
+        try:
+            module = __import__(name)
+        except ImportError:
+            if backend is not None:
+                raise
+            continue
+        return module.loads
+    return json.loads
+
+
+def iter_jsonl(path, loads=json.loads):
+    '''Yield the documents of a JSONL file one at a time, skipping blank lines.'''
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield loads(line)
 
-def get_normalized_answer(input_string) -> str:
-    """Lower text and remove punctuation, articles and extra whitespace."""
 
-    def remove_articles(text: str):
-        return re.sub(r"\b(a|an|the)\b", " ", text)
+# Upper bound on distinct strings kept by the normalization cache.
+NORMALIZATION_CACHE_SIZE = 2 ** 18
 
-    def white_space_fix(text: str):
-        return " ".join(text.split())
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+_ARTICLES_RE = re.compile(r"\b(a|an|the)\b")
 
-    def remove_punc(text: str):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+# Normalized form of a span: the normalized string, its tokens and their counts.
+SpanTokens = namedtuple("SpanTokens", ["normalized", "tokens", "counts"])
 
-    def lower(text: str):
-        return text.lower()
 
-    return white_space_fix(remove_articles(remove_punc(lower(input_string))))
+@lru_cache(maxsize=NORMALIZATION_CACHE_SIZE)
+def tokenize_span(input_string) -> SpanTokens:
+    """Lower text and remove punctuation, articles and extra whitespace, then tokenize."""
+    text = input_string.lower().translate(_PUNCTUATION_TABLE)
+    tokens = tuple(_ARTICLES_RE.sub(" ", text).split())
+    return SpanTokens(" ".join(tokens), tokens, Counter(tokens))
+
+
+def as_span_tokens(span) -> SpanTokens:
+    if isinstance(span, SpanTokens):
+        return span
+    return tokenize_span(span)
+
+
+def get_normalized_answer(input_string) -> str:
+    """Lower text and remove punctuation, articles and extra whitespace."""
+    return as_span_tokens(input_string).normalized
 
 
 def get_tokens(input_string):
-    return get_normalized_answer(input_string).split()
+    return list(as_span_tokens(input_string).tokens)
 
 
 def compute_exact_match(label_str, pred_str):
-    return get_normalized_answer(pred_str) == get_normalized_answer(label_str)
+    return as_span_tokens(pred_str).normalized == as_span_tokens(label_str).normalized
 
 
-def compute_bow_f1(label_str, pred_str, return_pr=False):
-    prediction_tokens = get_tokens(pred_str)
-    ground_truth_tokens = get_tokens(label_str)
-    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
-    num_same = sum(common.values())
+def bow_prf(num_same, num_pred, num_gold):
+    '''Bag-of-words precision, recall and F1 from the token overlap and span lengths.'''
     if num_same == 0:
-        if return_pr: return 0, 0, 0 
-        else: return 0
-    precision = 1.0 * num_same / len(prediction_tokens)
-    recall = 1.0 * num_same / len(ground_truth_tokens)
+        return 0, 0, 0
+    precision = 1.0 * num_same / num_pred
+    recall = 1.0 * num_same / num_gold
     f1 = (2 * precision * recall) / (precision + recall)
+    return precision, recall, f1
+
+
+def compute_bow_f1(label_str, pred_str, return_pr=False):
+    prediction = as_span_tokens(pred_str)
+    ground_truth = as_span_tokens(label_str)
+    common = prediction.counts & ground_truth.counts
+    precision, recall, f1 = bow_prf(sum(common.values()), len(prediction.tokens), len(ground_truth.tokens))
     if return_pr:
         return precision, recall, f1
     else:
         return f1
 
 
-def get_pred_label_spans(pred_path, test_file, ignore_non_entity=False):
+def get_span_tokens(item):
+    '''Return the tokenized spans of a ``label_id2spans`` or ``pred_id2spans`` item.'''
+    if "tokens" in item:
+        return item["tokens"]
+    if item["spans"] and isinstance(item["spans"][0], list):
+        return [[tokenize_span(span) for span in spans] for spans in item["spans"]]
+    return [tokenize_span(span) for span in item["spans"]]
+
+
+_WORD_RE = re.compile(r"\S+")
+
+# Token interval of the "<NA>" spans of non-entity arguments; it never overlaps a document token.
+NON_ENTITY_INTERVAL = (-1, 0)
+
+
+def document_token_offsets(text):
+    '''Return the character ``starts`` and ``ends`` of the tokens of ``text``:
+       every whitespace-separated word that ``tokenize_span`` keeps a token of.
+    '''
+    starts, ends = array("i"), array("i")
+    for match in _WORD_RE.finditer(text):
+        if tokenize_span(match.group()).tokens:
+            starts.append(match.start())
+            ends.append(match.end())
+    return starts, ends
+
+
+def get_pred_label_spans(pred_path, test_file, ignore_non_entity=False, json_backend=None):
     '''Compute metrics for each role of each trigger mention.
        1. Count all mentions; 
        2. Average the metric across all mentions
+       Both files are streamed one document at a time and only the spans and
+       trigger metadata needed for scoring are kept.
     ''' 
+    loads = get_json_loads(json_backend)
     # convert to ``id to label per role type``
     # {
     #     `doc id-event id-trigger id-label role type`: {`event type`: ``label type``, `spans`: [[`text`]]} # each item in spans is an entity
     # }
-    maven_data = []
-    with open(test_file) as f:
-        for line in f.readlines():
-            maven_data.append(json.loads(line.strip()))
     label_id2spans = defaultdict(list)
     all_triggers = {} # {id: event_type}
-    docid2text = {}
+    doc_ids = set()
     tid2eid = {}
-    for item in maven_data:
-        docid2text[item["id"]] = item["text"]
+    for item in iter_jsonl(test_file, loads):
+        doc_ids.add(item["id"])
+        text = item["text"]
         for event in item["events"]:
             for trigger in event["triggers"]:
                 all_triggers[f"{item['id']}-{event['id']}-{trigger['id']}"] = event["type"]
@@ -101,7 +205,8 @@ def get_pred_label_spans(pred_path, test_file, ignore_non_entity=False):
                     if id not in label_id2spans: # Maybe multiple arguments have the same role
                         label_id2spans[id] = {
                             "event_type": event["type"],
-                            "spans": []
+                            "spans": [],
+                            "tokens": []
                         }
                     spans = []
                     if "non-entity" in argument["id"] and ignore_non_entity:
@@ -110,8 +215,9 @@ def get_pred_label_spans(pred_path, test_file, ignore_non_entity=False):
                         # continue
                     else:
                         for mention in argument["mentions"]:
-                            spans.append(item["text"][mention["position"][0]:mention["position"][1]])
+                            spans.append(text[mention["position"][0]:mention["position"][1]])
                     label_id2spans[id]["spans"].append(spans)
+                    label_id2spans[id]["tokens"].append([tokenize_span(span) for span in spans])
         for mention in item['negative_triggers']:
             tid2eid[mention['id']]="NA"
     # (doc id, event id, trigger id, pred event type, position, pred role type)
@@ -120,120 +226,978 @@ def get_pred_label_spans(pred_path, test_file, ignore_non_entity=False):
     #     `doc id-event id-trigger id-pred role type`: {`event type`: ``pred type``, `spans`: [`text`]}
     # }
     pred_id2spans = {}
-    with open(pred_path, "r") as fin:
-        lines=fin.readlines()
-        for line in lines:
-            doc=json.loads(line)
-            if doc['id'] not in docid2text:
+    for doc in iter_jsonl(pred_path, loads):
+        if doc['id'] not in doc_ids:
+            continue
+        for tid, pred in doc['preds'].items():
+            if tid not in tid2eid:
                 continue
-            for tid in doc['preds']:
-                if tid not in tid2eid:
+            event_id=tid2eid[tid]
+            event_type=pred['event_type']
+            for role in pred:
+                if role=='event_type':
                     continue
-                event_id=tid2eid[tid]
-                event_type=doc['preds'][tid]['event_type']
-                for role in doc['preds'][tid]:
-                    if role=='event_type':
-                        continue
-                    id = f"{doc['id']}-{event_id}-{tid}-{event_type}.{role}"
-                    pred_id2spans[id]={
-                        "event_type": event_type,
-                        "spans": doc['preds'][tid][role]
-                    }
+                id = f"{doc['id']}-{event_id}-{tid}-{event_type}.{role}"
+                pred_id2spans[id]={
+                    "event_type": event_type,
+                    "spans": pred[role],
+                    "tokens": [tokenize_span(span) for span in pred[role]]
+                }
     
     return label_id2spans, pred_id2spans, all_triggers
 
 
-def find_optimal_match(gold_spans, pred_spans):
-    scores = np.zeros([len(gold_spans), len(pred_spans)])
-    for gold_index, gold_item in enumerate(gold_spans):
-        for pred_index, pred_item in enumerate(pred_spans):
-            scores[gold_index, pred_index] = compute_bow_f1(gold_item, pred_item)
-    row_ind, col_ind = linear_sum_assignment(-scores)
+# Token id of predicted tokens that never occur in a gold span.
+UNKNOWN_TOKEN = -1
 
-    return row_ind, [(gold_spans[i], pred_spans[j]) for i, j in zip(row_ind, col_ind)]
 
+class StringTable:
+    '''Interned strings with dense integer ids.'''
 
-def compute_mention_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
-    mention_exact_match = []
-    mention_bow = {
-        "precision": [],
-        "recall": [],
-        "f1": []
-    }
-    # for all triggers
-    for trigger in all_triggers:
-        event_type = all_triggers[trigger]
-        all_roles = schema[event_type]
-        for role in all_roles:
-            role = f"{event_type}.{role}"
-            id = f"{trigger}-{role}"
-            if id not in pred_id2spans:
-                if id not in label_id2spans: 
-                    continue
-                else: # false negative roles
-                    # gold_spans = [span for spans in label_id2spans[id]["spans"] for span in spans]
-                    # mention_exact_match.extend([0]*len(gold_spans))
-                    # for key in mention_bow:
-                    #     mention_bow[key].extend([0]*len(gold_spans))
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
-            else:
-                if id not in label_id2spans: # 1. false positive roles
-                    # pred_spans = pred_id2spans[id]["spans"]
-                    # mention_exact_match.extend([0]*len(pred_spans))
-                    # for key in mention_bow:
-                    #     mention_bow[key].extend([0]*len(pred_spans))
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
-                else:
-                    if pred_id2spans[id]["event_type"] != label_id2spans[id]["event_type"]:
-                        # gold_spans = [span for spans in label_id2spans[id]["spans"] for span in spans]
-                        # mention_exact_match.extend([0]*len(gold_spans))
-                        # for key in mention_bow:
-                        #     mention_bow[key].extend([0]*len(gold_spans))
-                        mention_exact_match.append(0)
-                        for key in mention_bow:
-                            mention_bow[key].append(0)
+    def __init__(self, strings=()):
+        self.strings = []
+        self.ids = {}
+        for string in strings:
+            self.intern(string)
+
+    @classmethod
+    def from_unique(cls, strings):
+        table = cls()
+        table.strings = list(strings)
+        table.ids = dict(zip(table.strings, range(len(table.strings))))
+        return table
+
+    def intern(self, string):
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id
+
+    def get(self, string, default=None):
+        return self.ids.get(string, default)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, id):
+        return self.strings[id]
+
+
+class GoldIndex:
+    '''Integer-keyed gold annotations and schema.
+       Doc, trigger, event type, role and token strings are interned into
+       ``StringTable``s. ``arguments`` maps ``(trigger, role)`` ids to the gold
+       entities of that role, each a list of mentions given as token id tuples.
+       Triggers of negative (``NA``) instances are kept in ``na_triggers``.
+       With ``offsets=True`` mentions are ``(start, end)`` token intervals of
+       their document instead, and the character offsets of the tokens of
+       every document are kept in ``doc_token_starts`` and ``doc_token_ends``,
+       delimited by ``doc_token_ptr``, and its length in ``doc_lengths``.
+    '''
+
+    def __init__(self, schema=None, offsets=False):
+        self.docs = StringTable()
+        self.triggers = StringTable()
+        self.event_types = StringTable()
+        self.roles = StringTable()
+        self.tokens = StringTable()
+        # per trigger id; -1 for the triggers of negative instances
+        self.trigger_doc = array("i")
+        self.trigger_event = array("i")
+        self.trigger_type = array("i")
+        # gold triggers in document order
+        self.gold_triggers = array("i")
+        self.na_triggers = set()
+        self.n_events = 0
+        self.schema_roles = {}
+        self.arguments = {}
+        self.offsets = offsets
+        self.doc_token_ptr = array("q", [0])
+        self.doc_token_starts = array("i")
+        self.doc_token_ends = array("i")
+        self.doc_lengths = array("i")
+        self._events = {}
+        if schema is not None:
+            self.add_schema(schema)
+
+    def add_schema(self, schema):
+        for event_type, roles in schema.items():
+            self.schema_roles[self.event_types.intern(event_type)] = \
+                [self.roles.intern(f"{event_type}.{role}") for role in roles]
+
+    def add_trigger(self, trigger_id, doc, event_id, event_type):
+        assert trigger_id not in self.triggers.ids
+        trigger = self.triggers.intern(trigger_id)
+        event = self._events.setdefault((doc, event_id), len(self._events))
+        self.n_events = len(self._events)
+        self.trigger_doc.append(doc)
+        self.trigger_event.append(event)
+        self.trigger_type.append(self.event_types.intern(event_type))
+        self.gold_triggers.append(trigger)
+        return trigger
+
+    def add_negative_trigger(self, trigger_id, doc):
+        trigger = self.triggers.get(trigger_id)
+        if trigger is None:
+            trigger = self.triggers.intern(trigger_id)
+            self.trigger_doc.append(doc)
+            self.trigger_event.append(-1)
+            self.trigger_type.append(-1)
+        self.na_triggers.add(trigger)
+        return trigger
+
+    def span_ids(self, tokens):
+        return tuple([self.tokens.intern(token) for token in tokens])
+
+    def add_document_tokens(self, doc, text):
+        if doc == len(self.doc_token_ptr) - 1:
+            starts, ends = document_token_offsets(text)
+            self.doc_token_starts.extend(starts)
+            self.doc_token_ends.extend(ends)
+            self.doc_token_ptr.append(len(self.doc_token_starts))
+            self.doc_lengths.append(len(text))
+
+    def span_interval(self, doc, start, end):
+        '''Return the ``(first, last + 1)`` document tokens overlapping characters ``[start, end)``.'''
+        lo, hi = self.doc_token_ptr[doc], self.doc_token_ptr[doc + 1]
+        first = bisect_right(self.doc_token_ends, start, lo, hi)
+        last = bisect_left(self.doc_token_starts, end, first, hi)
+        return first - lo, last - lo
+
+
+class PredIndex:
+    '''Integer-keyed predictions of one submission against a ``GoldIndex``.
+       ``arguments`` maps ``(trigger, role)`` ids to ``(event type id, spans)``
+       with spans as token id tuples; ``false_positives`` holds the
+       ``(doc, trigger, role)`` ids of predictions for ``NA`` triggers. Event types
+       and roles missing from the gold tables get ids past the end of them.
+    '''
+
+    def __init__(self, gold):
+        self.gold = gold
+        self.arguments = {}
+        self.false_positives = set()
+        self._extra_event_types = {}
+        self._extra_roles = {}
+
+    def event_type_id(self, event_type):
+        id = self.gold.event_types.get(event_type)
+        if id is None:
+            id = self._extra_event_types.setdefault(
+                event_type, len(self.gold.event_types) + len(self._extra_event_types))
+        return id
+
+    def role_id(self, role):
+        id = self.gold.roles.get(role)
+        if id is None:
+            id = self._extra_roles.setdefault(role, len(self.gold.roles) + len(self._extra_roles))
+        return id
+
+    def span_ids(self, tokens):
+        token_ids = self.gold.tokens.ids
+        return tuple([token_ids.get(token, UNKNOWN_TOKEN) for token in tokens])
+
+    def span_interval(self, doc, span):
+        '''Token interval of a ``[start, end]`` character offset prediction.'''
+        if span == "<NA>":
+            return NON_ENTITY_INTERVAL
+        if not (isinstance(span, (list, tuple)) and len(span) == 2
+                and all(isinstance(offset, int) for offset in span)):
+            raise ValueError(f"expected a [start, end] offset pair, got {span!r}")
+        start, end = span
+        if not 0 <= start <= end <= self.gold.doc_lengths[doc]:
+            raise ValueError(f"offsets {span!r} out of range of a document of {self.gold.doc_lengths[doc]} characters")
+        return self.gold.span_interval(doc, start, end)
+
+
+def index_gold(docs, schema, ignore_non_entity=False, offsets=False):
+    '''Build a ``GoldIndex`` from an iterable of ``test.unified.jsonl`` documents.'''
+    gold = GoldIndex(schema, offsets)
+    for item in docs:
+        doc = gold.docs.intern(item["id"])
+        text = item["text"]
+        if offsets:
+            gold.add_document_tokens(doc, text)
+        for event in item["events"]:
+            if event["type"] not in schema:
+                raise KeyError(event["type"])
+            for trigger in event["triggers"]:
+                trigger_idx = gold.add_trigger(trigger["id"], doc, event["id"], event["type"])
+                for argument in trigger["arguments"]:
+                    # Maybe multiple arguments have the same role
+                    entities = gold.arguments.setdefault((trigger_idx, gold.roles.intern(argument["role"])), [])
+                    if offsets:
+                        if "non-entity" in argument["id"] and ignore_non_entity:
+                            entities.append([NON_ENTITY_INTERVAL] * len(argument["mentions"]))
+                        else:
+                            entities.append([gold.span_interval(doc, *mention["position"])
+                                             for mention in argument["mentions"]])
+                        continue
+                    if "non-entity" in argument["id"] and ignore_non_entity:
+                        spans = ["<NA>"] * len(argument["mentions"])
                     else:
-                        gold_spans = [span for spans in label_id2spans[id]["spans"] for span in spans]
-                        pred_spans = pred_id2spans[id]["spans"]
-                        gold_span_idx, pairs = find_optimal_match(gold_spans, pred_spans)
-                        penalty = min(len(gold_spans), len(pred_spans)) / max(len(gold_spans), len(pred_spans))
-                        # import pdb; pdb.set_trace()
-                        for pair in pairs:
-                            em = int(compute_exact_match(pair[0], pair[1]))
-                            p, r, f1 = compute_bow_f1(pair[0], pair[1], True)
-                            mention_exact_match.append(em * penalty)
-                            mention_bow["precision"].append(p * penalty)
-                            mention_bow["recall"].append(r * penalty)
-                            mention_bow["f1"].append(f1 * penalty)
-                        # # penalty
-                        # diff = abs(len(gold_spans) - len(pred_spans))
-                        # mention_exact_match.extend([0]*diff)
-                        # for key in mention_bow:
-                        #     mention_bow[key].extend([0]*diff)
-    # for false positive trigger predictions
-    for id in pred_id2spans:
-        event_id = id.split("-")[1]
-        if event_id == "NA":
-            # pred_spans = pred_id2spans[id]["spans"]
-            # mention_exact_match.extend([0]*len(pred_spans))
-            # for key in mention_bow:
-            #     mention_bow[key].extend([0]*len(pred_spans))
-            mention_exact_match.append(0)
-            for key in mention_bow:
-                mention_bow[key].append(0)
-    # average across all mentions
-    global_res = {
-        "EM": np.mean(mention_exact_match) * 100,
-        "Precision": np.mean(mention_bow["precision"]) * 100,
-        "Recall": np.mean(mention_bow["recall"]) * 100,
-        "F1": np.mean(mention_bow["f1"]) * 100
+                        spans = [text[mention["position"][0]:mention["position"][1]] for mention in argument["mentions"]]
+                    entities.append([gold.span_ids(tokenize_span(span).tokens) for span in spans])
+        for mention in item["negative_triggers"]:
+            gold.add_negative_trigger(mention["id"], doc)
+    return gold
+
+
+def index_predictions(docs, gold):
+    '''Build a ``PredIndex`` from an iterable of ``test_prediction.jsonl`` documents.
+       Predictions that can never be scored (unknown documents or triggers,
+       roles outside the gold tables, triggers of other documents) are dropped.
+       Against an ``offsets`` gold index every argument span is a ``[start, end]``
+       character offset pair into the document text. Spans are then compared
+       by position, not by their normalized tokens: a span copied from another
+       occurrence of the same string does not match, and spans without tokens
+       (such as "the") map to empty intervals that are only equal at the same
+       position, while any two empty token sequences are equal in the string mode.
+    '''
+    preds = PredIndex(gold)
+    span_cache = {}
+    for doc in docs:
+        doc_idx = gold.docs.get(doc["id"])
+        if doc_idx is None:
+            continue
+        for tid, pred in doc["preds"].items():
+            trigger = gold.triggers.get(tid)
+            if trigger is None:
+                continue
+            event_type = pred["event_type"]
+            is_na = trigger in gold.na_triggers
+            if not is_na and gold.trigger_doc[trigger] != doc_idx:
+                continue
+            type_idx = preds.event_type_id(event_type)
+            for role in pred:
+                if role == "event_type":
+                    continue
+                role_idx = preds.role_id(f"{event_type}.{role}")
+                if is_na:
+                    preds.false_positives.add((doc_idx, trigger, role_idx))
+                    continue
+                if role_idx >= len(gold.roles):
+                    continue
+                if gold.offsets:
+                    preds.arguments[(trigger, role_idx)] = \
+                        (type_idx, [preds.span_interval(doc_idx, span) for span in pred[role]])
+                    continue
+                spans = []
+                for span in pred[role]:
+                    span_ids = span_cache.get(span)
+                    if span_ids is None:
+                        span_ids = span_cache[span] = preds.span_ids(tokenize_span(span).tokens)
+                    spans.append(span_ids)
+                preds.arguments[(trigger, role_idx)] = (type_idx, spans)
+    return preds
+
+
+def load_gold(test_file, schema, ignore_non_entity=False, json_backend=None, offsets=False):
+    return index_gold(iter_jsonl(test_file, get_json_loads(json_backend)), schema, ignore_non_entity, offsets)
+
+
+def load_predictions(pred_path, gold, json_backend=None):
+    return index_predictions(iter_jsonl(pred_path, get_json_loads(json_backend)), gold)
+
+
+# Bump when the layout of compiled gold artifacts changes.
+GOLD_ARTIFACT_VERSION = 3
+_GOLD_ARTIFACT_MAGIC = b"MAVENARG"
+_GOLD_ARTIFACT_TABLES = ("docs", "triggers", "event_types", "roles", "tokens")
+
+
+class MappedArguments:
+    '''Read-only ``(trigger, role) -> entities`` view of the arguments of a gold artifact.
+       Arguments are grouped by trigger; entities, mentions and token ids are
+       stored as offset arrays into each other and materialized on lookup.
+    '''
+
+    def __init__(self, trigger_arg_ptr, arg_role, arg_entity_ptr, entity_mention_ptr, mention_token_ptr, token_ids):
+        self.trigger_arg_ptr = trigger_arg_ptr
+        self.arg_role = arg_role
+        self.arg_entity_ptr = arg_entity_ptr
+        self.entity_mention_ptr = entity_mention_ptr
+        self.mention_token_ptr = mention_token_ptr
+        self.token_ids = token_ids
+
+    def get(self, key, default=None):
+        trigger, role = key
+        arg_role = self.arg_role
+        for arg in range(self.trigger_arg_ptr[trigger], self.trigger_arg_ptr[trigger + 1]):
+            if arg_role[arg] == role:
+                break
+        else:
+            return default
+        entity_mention_ptr = self.entity_mention_ptr
+        mention_token_ptr = self.mention_token_ptr
+        token_ids = self.token_ids
+        return [[tuple(token_ids[mention_token_ptr[mention]:mention_token_ptr[mention + 1]])
+                 for mention in range(entity_mention_ptr[entity], entity_mention_ptr[entity + 1])]
+                for entity in range(self.arg_entity_ptr[arg], self.arg_entity_ptr[arg + 1])]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.arg_role)
+
+
+class MappedGoldIndex(GoldIndex):
+    '''``GoldIndex`` whose arrays are memory-mapped from a gold artifact.
+       Pickles as the artifact path, so worker processes map the file themselves.
+    '''
+
+    def __reduce__(self):
+        return load_gold_artifact, (self.path,)
+
+
+def save_gold_artifact(gold, path, key=""):
+    '''Write a ``GoldIndex`` to a binary gold artifact.
+       The file holds a JSON header followed by 8-byte aligned blobs: the string
+       tables, joined by NUL characters, and the integer arrays of the triggers,
+       schema and tokenized arguments.
+    '''
+    arrays = {
+        "trigger_doc": array("i", gold.trigger_doc),
+        "trigger_event": array("i", gold.trigger_event),
+        "trigger_type": array("i", gold.trigger_type),
+        "gold_triggers": array("i", gold.gold_triggers),
+        "na_triggers": array("i", sorted(gold.na_triggers)),
+        "schema_types": array("i"),
+        "schema_role_ptr": array("q", [0]),
+        "schema_roles": array("i"),
+        "trigger_arg_ptr": array("q", [0]),
+        "arg_role": array("i"),
+        "arg_entity_ptr": array("q", [0]),
+        "entity_mention_ptr": array("q", [0]),
+        "mention_token_ptr": array("q", [0]),
+        "token_ids": array("i"),
+        "doc_token_ptr": array("q", gold.doc_token_ptr),
+        "doc_token_starts": array("i", gold.doc_token_starts),
+        "doc_token_ends": array("i", gold.doc_token_ends),
+        "doc_lengths": array("i", gold.doc_lengths),
     }
-    # print("Mention Level: Exact Match: {}, Bag-of-Words F1: {}".format(global_em, global_bow))
-    return global_res
+    for event_type, roles in gold.schema_roles.items():
+        arrays["schema_types"].append(event_type)
+        arrays["schema_roles"].extend(roles)
+        arrays["schema_role_ptr"].append(len(arrays["schema_roles"]))
+    trigger_arguments = defaultdict(list)
+    for (trigger, role), entities in gold.arguments.items():
+        trigger_arguments[trigger].append((role, entities))
+    for trigger in range(len(gold.triggers)):
+        for role, entities in trigger_arguments.get(trigger, ()):
+            arrays["arg_role"].append(role)
+            for mentions in entities:
+                for mention in mentions:
+                    arrays["token_ids"].extend(mention)
+                    arrays["mention_token_ptr"].append(len(arrays["token_ids"]))
+                arrays["entity_mention_ptr"].append(len(arrays["mention_token_ptr"]) - 1)
+            arrays["arg_entity_ptr"].append(len(arrays["entity_mention_ptr"]) - 1)
+        arrays["trigger_arg_ptr"].append(len(arrays["arg_role"]))
+
+    blobs = []
+    for name in _GOLD_ARTIFACT_TABLES:
+        strings = getattr(gold, name).strings
+        assert not any("\0" in string for string in strings)
+        blobs.append((name, "s", "\0".join(strings).encode("utf-8")))
+    for name, values in arrays.items():
+        blobs.append((name, values.typecode, values.tobytes()))
+    header = {"version": GOLD_ARTIFACT_VERSION, "key": key, "n_events": gold.n_events, "offsets": gold.offsets,
+              "blobs": {}}
+    offset = 0
+    for name, typecode, data in blobs:
+        header["blobs"][name] = [offset, len(data), typecode]
+        offset += -(-len(data) // 8) * 8
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_GOLD_ARTIFACT_MAGIC + struct.pack("<Q", len(header)) + header)
+        for _, _, data in blobs:
+            f.write(data + b"\0" * (-len(data) % 8))
+    os.replace(tmp_path, path)
+
+
+def load_gold_artifact(path, key=None):
+    '''Memory-map a gold artifact written by ``save_gold_artifact``.
+       Raises ``ValueError`` if the file is not a current artifact or, when
+       ``key`` is given, was compiled from other inputs.
+    '''
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(_GOLD_ARTIFACT_MAGIC)] != _GOLD_ARTIFACT_MAGIC:
+        raise ValueError(f"{path} is not a gold artifact")
+    start = len(_GOLD_ARTIFACT_MAGIC) + 8
+    if len(buffer) < start:
+        raise ValueError(f"{path} is truncated")
+    header_len, = struct.unpack("<Q", buffer[len(_GOLD_ARTIFACT_MAGIC):start])
+    header = json.loads(buffer[start:start + header_len])
+    if header["version"] != GOLD_ARTIFACT_VERSION or (key is not None and header["key"] != key):
+        raise ValueError(f"{path} is stale")
+    data = memoryview(buffer)[start + header_len:]
+    if any(offset + length > len(data) for offset, length, _ in header["blobs"].values()):
+        raise ValueError(f"{path} is truncated")
+
+    def blob(name):
+        offset, length, typecode = header["blobs"][name]
+        view = data[offset:offset + length]
+        return bytes(view).decode("utf-8") if typecode == "s" else view.cast(typecode)
+
+    gold = MappedGoldIndex.__new__(MappedGoldIndex)
+    gold.path = path
+    for name in _GOLD_ARTIFACT_TABLES:
+        text = blob(name)
+        setattr(gold, name, StringTable.from_unique(text.split("\0") if text else []))
+    gold.trigger_doc = blob("trigger_doc")
+    gold.trigger_event = blob("trigger_event")
+    gold.trigger_type = blob("trigger_type")
+    gold.gold_triggers = blob("gold_triggers")
+    gold.na_triggers = set(blob("na_triggers"))
+    gold.n_events = header["n_events"]
+    schema_role_ptr, schema_roles = blob("schema_role_ptr"), blob("schema_roles")
+    gold.schema_roles = {event_type: list(schema_roles[schema_role_ptr[i]:schema_role_ptr[i + 1]])
+                         for i, event_type in enumerate(blob("schema_types"))}
+    gold.arguments = MappedArguments(blob("trigger_arg_ptr"), blob("arg_role"), blob("arg_entity_ptr"),
+                                     blob("entity_mention_ptr"), blob("mention_token_ptr"), blob("token_ids"))
+    gold.offsets = header["offsets"]
+    gold.doc_token_ptr = blob("doc_token_ptr")
+    gold.doc_token_starts = blob("doc_token_starts")
+    gold.doc_token_ends = blob("doc_token_ends")
+    gold.doc_lengths = blob("doc_lengths")
+    gold._events = None
+    return gold
+
+
+def gold_cache_key(test_file, schema_file, ignore_non_entity=False, offsets=False):
+    '''Content hash of the inputs of a gold artifact.'''
+    digest = hashlib.sha256(f"{GOLD_ARTIFACT_VERSION}:{ignore_non_entity}:{offsets}".encode("utf-8"))
+    for path in (test_file, schema_file):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_gold_cached(test_file, schema_file, cache_dir, ignore_non_entity=False, json_backend=None, offsets=False):
+    '''Load the gold index through a compiled artifact in ``cache_dir``.
+       The artifact is keyed by the content hash of ``test_file`` and
+       ``schema_file``; a missing or stale artifact is rebuilt and replaces the
+       artifacts compiled from earlier versions of the same files in the same
+       mode. Artifacts of other reference sets or modes sharing ``cache_dir``
+       are kept.
+    '''
+    key = gold_cache_key(test_file, schema_file, ignore_non_entity, offsets)
+    source = hashlib.sha256(f"{os.path.realpath(test_file)}\0{os.path.realpath(schema_file)}\0"
+                            f"{ignore_non_entity}:{offsets}".encode("utf-8")).hexdigest()
+    prefix = f"{os.path.basename(test_file)}-{source[:16]}-"
+    path = os.path.join(cache_dir, f"{prefix}{key[:32]}.gold")
+    if os.path.exists(path):
+        try:
+            return load_gold_artifact(path, key)
+        except (ValueError, OSError, KeyError):
+            pass
+    with open(schema_file) as f:
+        schema = json.load(f)
+    gold = load_gold(test_file, schema, ignore_non_entity, json_backend, offsets)
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".gold"):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:  # removed by a concurrent run
+                pass
+    save_gold_artifact(gold, path, key)
+    return gold
+
+
+def index_id2spans(label_id2spans, pred_id2spans, all_triggers, schema):
+    '''Build the ``GoldIndex`` and ``PredIndex`` of ``get_pred_label_spans`` output.'''
+    gold = GoldIndex(schema)
+    matched_preds = []
+    for trigger_key, event_type in all_triggers.items():
+        doc_id, event_id = trigger_key.split("-", 1)
+        event_id, trigger_id = event_id.rsplit("-", 1)
+        trigger = gold.add_trigger(trigger_id, gold.docs.intern(doc_id), event_id, event_type)
+        for role in gold.schema_roles[gold.event_types.ids[event_type]]:
+            id = f"{trigger_key}-{gold.roles[role]}"
+            if id in label_id2spans:
+                gold.arguments[(trigger, role)] = [[gold.span_ids(span.tokens) for span in spans]
+                                                   for spans in get_span_tokens(label_id2spans[id])]
+            if id in pred_id2spans:
+                matched_preds.append(((trigger, role), pred_id2spans[id]))
+    preds = PredIndex(gold)
+    for key, pred in matched_preds:
+        preds.arguments[key] = (preds.event_type_id(pred["event_type"]),
+                                [preds.span_ids(span.tokens) for span in get_span_tokens(pred)])
+    for id in pred_id2spans:
+        if is_false_positive_trigger(id):
+            doc_id, _, trigger_id, role = id.split("-", 3)
+            doc = gold.docs.intern(doc_id)
+            preds.false_positives.add((doc, gold.add_negative_trigger(trigger_id, doc), preds.role_id(role)))
+    return gold, preds
+
+
+# Score matrices with at most this many cells are filled cell by cell, which is
+# cheaper than NumPy for the common 1x1 and 1x2 cases.
+SCALAR_MATRIX_CELLS = 4
+# Number of (trigger, role) cases whose score matrices are computed together.
+MATCH_BATCH_SIZE = 512
+
+
+def token_f1_matrices(problems):
+    '''Compute bag-of-words precision, recall and F1 for every gold x pred cell.
+       ``problems`` is a list of ``(gold_spans, pred_spans)`` whose spans are
+       token sequences (token strings or integer token ids); one ``(precision,
+       recall, f1)`` triple of ``len(gold_spans) x len(pred_spans)`` arrays is
+       returned per problem, bit-identical to ``compute_bow_f1``.
+       Tokens are mapped to dense ids and the overlap of all cells is taken at
+       once from a sparse join of the gold and pred count vectors on
+       (problem, token id).
+    '''
+    results = [None] * len(problems)
+    vocab = {}
+    gold_tokens, gold_rows, gold_len = [], [], []
+    pred_tokens, pred_cols, pred_len = [], [], []
+    batched = []
+    for problem_idx, (gold_spans, pred_spans) in enumerate(problems):
+        if len(gold_spans) * len(pred_spans) <= SCALAR_MATRIX_CELLS:
+            shape = (len(gold_spans), len(pred_spans))
+            precision, recall, f1 = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+            for i, gold_item in enumerate(gold_spans):
+                gold_counts = Counter(gold_item)
+                for j, pred_item in enumerate(pred_spans):
+                    if pred_item == gold_item:
+                        num_same = len(gold_item)
+                    else:
+                        num_same = sum((Counter(pred_item) & gold_counts).values())
+                    precision[i, j], recall[i, j], f1[i, j] = bow_prf(num_same, len(pred_item), len(gold_item))
+            results[problem_idx] = (precision, recall, f1)
+            continue
+        batched.append((problem_idx, len(gold_spans), len(pred_spans)))
+        for span in gold_spans:
+            gold_rows.extend([len(gold_len)] * len(span))
+            gold_len.append(len(span))
+            gold_tokens.extend([vocab.setdefault(token, len(vocab)) for token in span])
+        for span in pred_spans:
+            pred_cols.extend([len(pred_len)] * len(span))
+            pred_len.append(len(span))
+            pred_tokens.extend([vocab.setdefault(token, len(vocab)) for token in span])
+    if not batched:
+        return results
+
+    vocab_size = max(len(vocab), 1)
+    n_gold = np.array([n for _, n, _ in batched], dtype=np.int64)
+    n_pred = np.array([n for _, _, n in batched], dtype=np.int64)
+    gold_base = np.concatenate([[0], np.cumsum(n_gold)[:-1]])
+    pred_base = np.concatenate([[0], np.cumsum(n_pred)[:-1]])
+    n_cells = n_gold * n_pred
+    cell_base = np.concatenate([[0], np.cumsum(n_cells)[:-1]])
+    gold_problem = np.repeat(np.arange(len(batched)), n_gold)
+    pred_problem = np.repeat(np.arange(len(batched)), n_pred)
+
+    def count_vectors(rows, tokens):
+        # sparse (row, token id) -> count entries
+        keys, counts = np.unique(np.asarray(rows, dtype=np.int64) * vocab_size
+                                 + np.asarray(tokens, dtype=np.int64), return_counts=True)
+        return keys // vocab_size, keys % vocab_size, counts
+
+    gold_row, gold_token, gold_count = count_vectors(gold_rows, gold_tokens)
+    pred_col, pred_token, pred_count = count_vectors(pred_cols, pred_tokens)
+    # one integer key per (problem, token id); pred keys come out sorted
+    gold_key = gold_problem[gold_row] * vocab_size + gold_token
+    pred_key = pred_problem[pred_col] * vocab_size + pred_token
+    order = np.argsort(pred_key, kind="stable")
+    pred_key, pred_col, pred_count = pred_key[order], pred_col[order], pred_count[order]
+    # join every gold entry with the pred entries sharing its key
+    lo = np.searchsorted(pred_key, gold_key, side="left")
+    hi = np.searchsorted(pred_key, gold_key, side="right")
+    n_match = hi - lo
+    joined = np.repeat(np.arange(len(gold_key)), n_match)
+    starts = np.cumsum(n_match) - n_match
+    pred_entry = np.repeat(lo - starts, n_match) + np.arange(int(n_match.sum()))
+    problem = gold_problem[gold_row[joined]]
+    cell = cell_base[problem] + (gold_row[joined] - gold_base[problem]) * n_pred[problem] \
+        + pred_col[pred_entry] - pred_base[problem]
+    overlap = np.bincount(cell, weights=np.minimum(gold_count[joined], pred_count[pred_entry]),
+                          minlength=int(n_cells.sum()))
+    # lengths of the gold and pred span of every cell
+    cell_problem = np.repeat(np.arange(len(batched)), n_cells)
+    cell_local = np.arange(len(overlap)) - cell_base[cell_problem]
+    gold_len = np.array(gold_len, dtype=np.float64)
+    pred_len = np.array(pred_len, dtype=np.float64)
+    cell_gold_len = gold_len[gold_base[cell_problem] + cell_local // n_pred[cell_problem]]
+    cell_pred_len = pred_len[pred_base[cell_problem] + cell_local % n_pred[cell_problem]]
+    precision, recall, f1 = cell_prf(overlap, cell_gold_len, cell_pred_len)
+    for batch_idx, (problem_idx, rows, cols) in enumerate(batched):
+        lo = cell_base[batch_idx]
+        hi = lo + rows * cols
+        results[problem_idx] = (precision[lo:hi].reshape(rows, cols),
+                                recall[lo:hi].reshape(rows, cols),
+                                f1[lo:hi].reshape(rows, cols))
+    return results
+
+
+def cell_prf(overlap, gold_len, pred_len):
+    '''Vectorized ``bow_prf`` of flat arrays of cell overlaps and span lengths.'''
+    hit = overlap > 0
+    # bincount returns integers when no cell overlaps at all
+    precision = np.zeros(len(overlap))
+    recall = np.zeros(len(overlap))
+    f1 = np.zeros(len(overlap))
+    np.divide(overlap, pred_len, out=precision, where=hit)
+    np.divide(overlap, gold_len, out=recall, where=hit)
+    np.divide(2 * precision * recall, precision + recall, out=f1, where=hit)
+    return precision, recall, f1
+
+
+def interval_f1_matrices(problems):
+    '''``token_f1_matrices`` for spans given as ``(start, end)`` token intervals.
+       The overlap of two spans is the length of the intersection of their
+       intervals, so the cells of all problems are computed with a few
+       integer array operations.
+    '''
+    if not problems:
+        return []
+    n_gold = np.array([len(gold_spans) for gold_spans, _ in problems], dtype=np.int64)
+    n_pred = np.array([len(pred_spans) for _, pred_spans in problems], dtype=np.int64)
+    gold = np.array([span for gold_spans, _ in problems for span in gold_spans], dtype=np.int64).reshape(-1, 2)
+    pred = np.array([span for _, pred_spans in problems for span in pred_spans], dtype=np.int64).reshape(-1, 2)
+    gold_base = np.concatenate([[0], np.cumsum(n_gold)[:-1]])
+    pred_base = np.concatenate([[0], np.cumsum(n_pred)[:-1]])
+    n_cells = n_gold * n_pred
+    cell_base = np.concatenate([[0], np.cumsum(n_cells)[:-1]])
+    cell_problem = np.repeat(np.arange(len(problems)), n_cells)
+    cell_local = np.arange(int(n_cells.sum())) - cell_base[cell_problem]
+    cols = n_pred[cell_problem]
+    gold_cell = gold[gold_base[cell_problem] + cell_local // np.maximum(cols, 1)]
+    pred_cell = pred[pred_base[cell_problem] + cell_local % np.maximum(cols, 1)]
+    overlap = np.minimum(gold_cell[:, 1], pred_cell[:, 1]) - np.maximum(gold_cell[:, 0], pred_cell[:, 0])
+    precision, recall, f1 = cell_prf(np.maximum(overlap, 0).astype(np.float64),
+                                     (gold_cell[:, 1] - gold_cell[:, 0]).astype(np.float64),
+                                     (pred_cell[:, 1] - pred_cell[:, 0]).astype(np.float64))
+    results = []
+    for rows, cols, lo in zip(n_gold.tolist(), n_pred.tolist(), cell_base.tolist()):
+        hi = lo + rows * cols
+        results.append((precision[lo:hi].reshape(rows, cols),
+                        recall[lo:hi].reshape(rows, cols),
+                        f1[lo:hi].reshape(rows, cols)))
+    return results
+
+
+def bow_f1_matrices(problems):
+    '''``token_f1_matrices`` for problems given as span strings or ``SpanTokens``.'''
+    return token_f1_matrices([([as_span_tokens(span).tokens for span in gold_spans],
+                               [as_span_tokens(span).tokens for span in pred_spans])
+                              for gold_spans, pred_spans in problems])
+
+
+def bow_f1_matrix(gold_spans, pred_spans):
+    return bow_f1_matrices([(gold_spans, pred_spans)])[0]
+
+
+# Opt in to splitting large mostly-zero score matrices into connected components
+# solved on their own. Equally optimal assignments may then be broken differently
+# than by ``linear_sum_assignment``, which changes EM, precision, recall and the
+# coref levels, so official scoring leaves this off. Set it before scoring starts
+# so that forked workers inherit it.
+SPARSE_ASSIGNMENT = False
+# Score matrices with at least this many cells and at most this fraction of
+# non-zero cells are split into connected components and solved sparsely.
+SPARSE_MIN_CELLS = 4096
+SPARSE_MAX_DENSITY = 0.1
+# Components at least this large use the sparse solver instead of the dense one.
+SPARSE_MIN_COMPONENT_CELLS = 1024
+# Below this many cells the dense solver is cheaper than checking for shortcuts.
+ASSIGNMENT_SHORTCUT_MIN_CELLS = 1024
+
+# How often each assignment path was taken, see ``solve_assignment``. Decomposed
+# matrices additionally count their components and the sparse solves among them,
+# and ``("cells", k)`` counts the matrices of 2 ** (k - 1) to 2 ** k - 1 cells.
+ASSIGNMENT_PATHS = ("empty", "single", "exact", "zero", "dense", "decomposed")
+ASSIGNMENT_STATS = Counter()
+
+
+def reset_assignment_stats():
+    ASSIGNMENT_STATS.clear()
+
+
+def matrix_size_histogram(stats=None):
+    '''Return the number of assignment matrices per cell count range.'''
+    stats = ASSIGNMENT_STATS if stats is None else stats
+    buckets = sorted(key[1] for key in stats if isinstance(key, tuple) and key[0] == "cells")
+    histogram = {}
+    for k in buckets:
+        low, high = (0, 0) if k == 0 else (2 ** (k - 1), 2 ** k - 1)
+        histogram[str(low) if low == high else f"{low}-{high}"] = stats["cells", k]
+    return histogram
+
+
+def format_assignment_stats(stats=None):
+    stats = ASSIGNMENT_STATS if stats is None else stats
+    total = sum(stats[path] for path in ASSIGNMENT_PATHS)
+    return "Assignment paths: " + ", ".join(
+        f"{path}={stats[path]}" for path in ASSIGNMENT_PATHS) \
+        + f" (total={total}, components={stats['components']}, sparse={stats['sparse']})"
+
+
+def solve_sparse_assignment(scores):
+    '''Maximum-score assignment of a mostly-zero matrix on its non-zero entries only.
+       The matching is reduced to a full bipartite matching with one dummy partner
+       per row and per column so that leaving a span unmatched is allowed.
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+    n_rows, n_cols = scores.shape
+    rows, cols = np.nonzero(scores)
+    n_edges = len(rows)
+    # rows: real rows, then one dummy per column; cols: real cols, then one dummy per row
+    edge_rows = np.concatenate([rows, np.arange(n_rows), n_rows + np.arange(n_cols), n_rows + cols])
+    edge_cols = np.concatenate([cols, n_cols + np.arange(n_rows), np.arange(n_cols), n_cols + rows])
+    # shift all weights by a constant so that they are non-zero; every full
+    # matching has n_rows + n_cols edges so the optimum is unchanged
+    weights = np.concatenate([2.0 - scores[rows, cols], np.full(n_rows + n_cols + n_edges, 2.0)])
+    size = n_rows + n_cols
+    graph = coo_matrix((weights, (edge_rows, edge_cols)), shape=(size, size)).tocsr()
+    row_ind, col_ind = min_weight_full_bipartite_matching(graph)
+    real = (row_ind < n_rows) & (col_ind < n_cols)
+    return row_ind[real], col_ind[real]
+
+
+def solve_components(scores):
+    '''Solve each connected component of the non-zero score graph on its own.'''
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    n_rows, n_cols = scores.shape
+    rows, cols = np.nonzero(scores)
+    graph = coo_matrix((np.ones(len(rows)), (rows, n_rows + cols)), shape=(n_rows + n_cols,) * 2)
+    n_components, labels = connected_components(graph, directed=False)
+    row_labels, col_labels = labels[:n_rows], labels[n_rows:]
+    row_ind, col_ind = [], []
+    for component in np.unique(labels[n_rows + cols]):
+        component_rows = np.flatnonzero(row_labels == component)
+        component_cols = np.flatnonzero(col_labels == component)
+        sub_scores = scores[np.ix_(component_rows, component_cols)]
+        ASSIGNMENT_STATS["components"] += 1
+        if sub_scores.size >= SPARSE_MIN_COMPONENT_CELLS:
+            ASSIGNMENT_STATS["sparse"] += 1
+            sub_rows, sub_cols = solve_sparse_assignment(sub_scores)
+        else:
+            sub_rows, sub_cols = linear_sum_assignment(-sub_scores)
+        row_ind.append(component_rows[sub_rows])
+        col_ind.append(component_cols[sub_cols])
+    row_ind = np.concatenate(row_ind)
+    col_ind = np.concatenate(col_ind)
+    # pair the remaining rows and columns with zero score, as the dense solver does
+    free_rows = np.setdiff1d(np.arange(n_rows), row_ind)
+    free_cols = np.setdiff1d(np.arange(n_cols), col_ind)
+    n_free = min(len(free_rows), len(free_cols))
+    row_ind = np.concatenate([row_ind, free_rows[:n_free]])
+    col_ind = np.concatenate([col_ind, free_cols[:n_free]])
+    order = np.argsort(row_ind)
+    return row_ind[order], col_ind[order]
+
+
+def solve_assignment(scores):
+    '''Maximum-score assignment of gold (rows) to pred (columns) spans.
+       Empty and single row or column matrices are solved in closed form. Matrices
+       of at least ``ASSIGNMENT_SHORTCUT_MIN_CELLS`` cells are also solved in closed
+       form when they are all zero or when their perfect (1.0) cells already form a
+       complete one-to-one matching. All of these give the same result as
+       ``linear_sum_assignment``. With ``SPARSE_ASSIGNMENT`` large mostly-zero
+       matrices are decomposed into connected components; equally optimal
+       assignments there may be broken differently than by the dense solver.
+       Every other matrix goes to ``linear_sum_assignment``.
+    '''
+    n_rows, n_cols = scores.shape
+    ASSIGNMENT_STATS["cells", (n_rows * n_cols).bit_length()] += 1
+    if n_rows == 0 or n_cols == 0:
+        ASSIGNMENT_STATS["empty"] += 1
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    if n_rows == 1:
+        ASSIGNMENT_STATS["single"] += 1
+        return np.zeros(1, dtype=np.intp), np.array([np.argmax(scores[0])])
+    if n_cols == 1:
+        ASSIGNMENT_STATS["single"] += 1
+        return np.array([np.argmax(scores[:, 0])]), np.zeros(1, dtype=np.intp)
+    from scipy.optimize import linear_sum_assignment
+    if scores.size < ASSIGNMENT_SHORTCUT_MIN_CELLS:
+        ASSIGNMENT_STATS["dense"] += 1
+        return linear_sum_assignment(-scores)
+    n_assigned = min(n_rows, n_cols)
+    exact_rows, exact_cols = np.nonzero(scores == 1.0)
+    if len(exact_rows) == n_assigned and len(np.unique(exact_cols)) == n_assigned \
+            and len(np.unique(exact_rows)) == n_assigned:
+        # the only assignment reaching the maximum total score
+        ASSIGNMENT_STATS["exact"] += 1
+        return exact_rows, exact_cols
+    n_nonzero = np.count_nonzero(scores)
+    if n_nonzero == 0:
+        ASSIGNMENT_STATS["zero"] += 1
+        return np.arange(n_assigned), np.arange(n_assigned)
+    if SPARSE_ASSIGNMENT and scores.size >= SPARSE_MIN_CELLS and n_nonzero <= SPARSE_MAX_DENSITY * scores.size:
+        ASSIGNMENT_STATS["decomposed"] += 1
+        return solve_components(scores)
+    ASSIGNMENT_STATS["dense"] += 1
+    return linear_sum_assignment(-scores)
+
+
+def find_optimal_match(gold_spans, pred_spans, scores=None):
+    if scores is None:
+        scores = bow_f1_matrix(gold_spans, pred_spans)[2]
+    row_ind, col_ind = solve_assignment(scores)
+
+    return row_ind, [(gold_spans[i], pred_spans[j]) for i, j in zip(row_ind, col_ind)]
+
+
+MENTION_LEVEL = "Mention_Level"
+ENTITY_COREF_LEVEL = "Entity_Coref_Level"
+EVENT_COREF_LEVEL = "Event_Coref_Level"
+METRIC_LEVELS = (MENTION_LEVEL, ENTITY_COREF_LEVEL, EVENT_COREF_LEVEL)
+
+
+def add_exact(partials, x):
+    '''Add ``x`` to a list of non-overlapping partial sums without rounding error.
+       ``math.fsum(partials)`` is the correctly rounded total, whatever the order
+       in which values and partial lists were combined.
+    '''
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+    return partials
+
+
+def exact_partials(values):
+    '''Return a few floats whose exact sum is the exact sum of ``values``.
+       Each round peels off the correctly rounded remainder with ``math.fsum``.
+    '''
+    partials = []
+    while True:
+        remainder = math.fsum(itertools.chain(values, [-x for x in partials]))
+        if remainder == 0.0:
+            return partials
+        partials.append(remainder)
+
+
+# Items buffered by a ScoreAccumulator before they are folded into its sums.
+ACCUMULATOR_BUFFER_SIZE = 4096
+
+
+class ScoreAccumulator:
+    '''Running EM/precision/recall/F1 sums and item count of one metric level.
+       Memory is O(1): items go through a bounded ``array`` buffer into the sums.
+       With ``compensated=True`` the sums are exact partials, so merging the
+       accumulators of any split of the items gives the same ``global_res`` as
+       scoring them together; otherwise they are plain running float sums.
+       ``keep_items=True`` also records every item in typed ``array`` vectors,
+       along with the group (role id) it was added under in ``groups``.
+    '''
+    METRICS = ("EM", "Precision", "Recall", "F1")
+
+    def __init__(self, compensated=True, keep_items=False):
+        self.compensated = compensated
+        self.count = 0
+        self.partials = [[] for _ in self.METRICS]
+        self.items = {metric: array("d") for metric in self.METRICS} if keep_items else None
+        self.groups = array("i") if keep_items else None
+        self._buffer = array("d")
+
+    def add(self, em, p, r, f1, group=-1):
+        self.count += 1
+        self._buffer.extend((em, p, r, f1))
+        if len(self._buffer) >= 4 * ACCUMULATOR_BUFFER_SIZE:
+            self._flush()
+        if self.items is not None:
+            for metric, value in zip(self.METRICS, (em, p, r, f1)):
+                self.items[metric].append(value)
+            self.groups.append(group)
+
+    def add_rows(self, rows, groups=-1):
+        '''Add the items of an ``(n, 4)`` array of EM, precision, recall and F1
+           rows, with one group per row or the same group for all of them.
+        '''
+        rows = np.ascontiguousarray(rows, dtype=np.float64)
+        self.count += len(rows)
+        self._buffer.frombytes(rows.tobytes())
+        if len(self._buffer) >= 4 * ACCUMULATOR_BUFFER_SIZE:
+            self._flush()
+        if self.items is not None:
+            for k, metric in enumerate(self.METRICS):
+                self.items[metric].frombytes(np.ascontiguousarray(rows[:, k]).tobytes())
+            if np.ndim(groups) == 0:
+                self.groups.extend(array("i", [groups]) * len(rows))
+            else:
+                self.groups.frombytes(np.asarray(groups, dtype=np.int32).tobytes())
+
+    def add_zeros(self, n=1, group=-1):
+        # zero items only change the count
+        self.count += n
+        if self.items is not None:
+            zeros = array("d", bytes(8 * n))
+            for metric in self.METRICS:
+                self.items[metric].extend(zeros)
+            self.groups.extend(array("i", [group]) * n)
+
+    def _flush(self):
+        buffer = self._buffer
+        if not buffer:
+            return
+        for k, partials in enumerate(self.partials):
+            values = buffer[k::4]
+            if self.compensated:
+                for x in exact_partials(values):
+                    add_exact(partials, x)
+            else:
+                partials[:] = [sum(values, partials[0] if partials else 0.0)]
+        del buffer[:]
+
+    def merge(self, other):
+        self._flush()
+        other._flush()
+        self.count += other.count
+        for partials, other_partials in zip(self.partials, other.partials):
+            if self.compensated:
+                for x in other_partials:
+                    add_exact(partials, x)
+            else:
+                partials[:] = [sum(other_partials, partials[0] if partials else 0.0)]
+        if self.items is not None and other.items is not None:
+            for metric in self.METRICS:
+                self.items[metric].extend(other.items[metric])
+            self.groups.extend(other.groups)
+        return self
+
+    def sums(self):
+        self._flush()
+        return {metric: math.fsum(partials) for metric, partials in zip(self.METRICS, self.partials)}
+
+    def state(self):
+        '''Return the count and partial sums as plain lists, for ``from_state``.'''
+        self._flush()
+        return [self.count] + [list(partials) for partials in self.partials]
+
+    @classmethod
+    def from_state(cls, state):
+        scores = cls()
+        scores.count = state[0]
+        scores.partials = [list(partials) for partials in state[1:]]
+        return scores
+
+    def global_res(self):
+        # average across all mentions
+        if self.count == 0:
+            return {metric: np.nan for metric in self.METRICS}
+        return {metric: total / self.count * 100 for metric, total in self.sums().items()}
 
 
 def merge_entity_score(gold_spans):
@@ -246,234 +1210,1009 @@ def merge_entity_score(gold_spans):
     return mention_idx_to_entity_idx
 
 
-def compute_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
-    mention_exact_match = []
-    mention_bow = {
-        "precision": [],
-        "recall": [],
-        "f1": []
-    }
-    # for all triggers
-    for trigger in all_triggers:
-        event_type = all_triggers[trigger]
-        all_roles = schema[event_type]
-        for role in all_roles:
-            role = f"{event_type}.{role}"
-            id = f"{trigger}-{role}"
-            if id not in pred_id2spans:
-                if id not in label_id2spans: 
-                    continue
-                else: # false negative roles
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
+def segment_first_max(segments, scores, n_segments):
+    '''Return the first row with the highest score of every segment, or -1
+       for segments without rows, like a running "keep if strictly greater"
+       over the rows in order.
+    '''
+    order = np.lexsort((np.arange(len(segments)), -scores, segments))
+    sorted_segments = segments[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_segments[1:] != sorted_segments[:-1]
+    best = np.full(n_segments, -1, dtype=np.int64)
+    best[sorted_segments[first]] = order[first]
+    return best
+
+
+def get_entity_scores(pair_entity, pair_scores, n_entities):
+    '''Keep the best matched mention of every gold entity.
+       ``pair_scores`` is an ``(n, 4)`` array of the EM, precision, recall and F1
+       of the matched pairs and ``pair_entity`` the entity of their gold
+       mention. Returns an ``(n_entities, 4)`` array holding, per entity, the
+       first pair with the highest F1, or zeros when no pair overlaps.
+    '''
+    scores = np.zeros((n_entities, 4))
+    best = segment_first_max(pair_entity, pair_scores[:, 3], n_entities)
+    entities = np.flatnonzero(best >= 0)
+    best_scores = pair_scores[best[entities]]
+    overlapping = best_scores[:, 3] > 0
+    scores[entities[overlapping]] = best_scores[overlapping]
+    return scores
+
+
+def merge_event_scores(row_event, row_entity, entity_scores, n_entities):
+    '''Merge the entity scores of coreferent triggers, keeping the best trigger per entity.
+       Rows of ``entity_scores`` belong to entity ``row_entity`` of event-role
+       ``row_event`` and come in trigger order; ``n_entities`` is the number of
+       entities of every event-role, those of its first trigger. Per entity the
+       maximum EM is kept, and precision, recall and F1 of the first trigger
+       with the highest F1. Returns the merged rows, event-role by event-role.
+    '''
+    if np.any(row_entity >= n_entities[row_event]):
+        raise IndexError("a trigger has more entities than the first trigger of its event")
+    base = np.concatenate([[0], np.cumsum(n_entities)[:-1]]).astype(np.int64)
+    segments = base[row_event] + row_entity
+    n_segments = int(n_entities.sum())
+    merged = entity_scores[segment_first_max(segments, entity_scores[:, 3], n_segments)]
+    max_em = np.zeros(n_segments)
+    np.maximum.at(max_em, segments, entity_scores[:, 0])
+    merged[:, 0] = max_em
+    return merged
+
+
+def case_rows(matched, counts, rows):
+    '''Lay out the item rows of a batch of cases in case order: one zero row
+       per unmatched case, ``counts`` rows of ``rows`` per matched case.
+       Returns the rows and the number of rows of every case.
+    '''
+    case_counts = np.ones(len(matched), dtype=np.int64)
+    case_counts[matched] = counts
+    starts = np.cumsum(case_counts) - case_counts
+    out = np.zeros((int(case_counts.sum()), 4))
+    if len(rows):
+        offsets = np.cumsum(counts) - counts
+        out[np.repeat(starts[matched] - offsets, counts) + np.arange(len(rows))] = rows
+    return out, case_counts
+
+
+def iter_match_cases(gold, preds, triggers):
+    '''Yield ``(trigger, role, gold_entities, pred_spans)`` for every scored (trigger, role).
+       ``gold_entities`` is ``None`` for false negative roles, false positive roles
+       and event type mismatches, which score zero.
+    '''
+    gold_arguments = gold.arguments
+    pred_arguments = preds.arguments
+    trigger_type = gold.trigger_type
+    schema_roles = gold.schema_roles
+    for trigger in triggers:
+        event_type = trigger_type[trigger]
+        for role in schema_roles[event_type]:
+            key = (trigger, role)
+            gold_entities = gold_arguments.get(key)
+            pred = pred_arguments.get(key)
+            if pred is None:
+                if gold_entities is not None:
+                    yield trigger, role, None, None
+            elif gold_entities is None or pred[0] != event_type:
+                yield trigger, role, None, None
             else:
-                if id not in label_id2spans: # 1. false positive roles
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
-                else:
-                    if pred_id2spans[id]["event_type"] != label_id2spans[id]["event_type"]:
-                        mention_exact_match.append(0)
-                        for key in mention_bow:
-                            mention_bow[key].append(0)
-                    else:
-                        gold_spans = [span for spans in label_id2spans[id]["spans"] for span in spans]
-                        pred_spans = pred_id2spans[id]["spans"]
-                        gold_span_idx, pairs = find_optimal_match(gold_spans, pred_spans)
-                        mention_idx_to_entity_idx = merge_entity_score(label_id2spans[id]["spans"])
-                        max_entity_score = []
-                        for i in range(len(label_id2spans[id]["spans"])):
-                            max_entity_score.append({
-                                "bow_f1": 0.0,
-                                "gold_span": None,
-                                "pred_span": None
-                            })
-                        for idx, pair in zip(gold_span_idx, pairs):
-                            p, r, f1 = compute_bow_f1(pair[0], pair[1], True)
-                            if f1 > max_entity_score[mention_idx_to_entity_idx[idx]]["bow_f1"]:
-                                max_entity_score[mention_idx_to_entity_idx[idx]] = {
-                                    "bow_f1": f1,
-                                    "gold_span": pair[0],
-                                    "pred_span": pair[1]
-                                }
-                        for entity in max_entity_score:
-                            if entity["gold_span"] is not None:
-                                em = int(compute_exact_match(entity["gold_span"], entity["pred_span"]))
-                                p, r, f1 = compute_bow_f1(entity["gold_span"], entity["pred_span"], True)
-                            else:
-                                em = 0
-                                p, r, f1 = 0, 0, 0
-                            mention_exact_match.append(em)
-                            mention_bow["precision"].append(p)
-                            mention_bow["recall"].append(r)
-                            mention_bow["f1"].append(f1)
+                yield trigger, role, gold_entities, pred[1]
 
-    # for false positive trigger predictions
-    for id in pred_id2spans:
-        event_id = id.split("-")[1]
-        if event_id == "NA":
-            mention_exact_match.append(0)
-            for key in mention_bow:
-                mention_bow[key].append(0)
-    # average across all mentions
-    global_res = {
-        "EM": np.mean(mention_exact_match) * 100,
-        "Precision": np.mean(mention_bow["precision"]) * 100,
-        "Recall": np.mean(mention_bow["recall"]) * 100,
-        "F1": np.mean(mention_bow["f1"]) * 100
-    }
-    # print("Entity Coref Level: Exact Match: {}, Bag-of-Words F1: {}".format(global_em, global_bow))
-    return global_res
 
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-def compute_event_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
-    mention_exact_match = []
-    mention_bow = {
-        "precision": [],
-        "recall": [],
-        "f1": []
-    }
+
+# Work done by score_triggers: triggers, (trigger, role) cases, matched cases and
+# pairs, and the seconds spent per phase, summed over worker processes.
+SCORING_STATS = Counter()
+
+
+def reset_scoring_stats():
+    SCORING_STATS.clear()
+    reset_assignment_stats()
+
+
+def score_triggers(gold, preds, triggers, levels=METRIC_LEVELS, n_false_positive_triggers=0,
+                   compensated=True, keep_items=False, by_doc=False):
+    '''Score the requested metric levels in a single pass over ``triggers``.
+       Each (trigger, role) is matched once and its pair scores feed the mention,
+       entity coref and event coref aggregates. Cases are processed
+       ``MATCH_BATCH_SIZE`` at a time: score matrices come from
+       ``token_f1_matrices``, or ``interval_f1_matrices`` for an ``offsets``
+       gold index, and the matched pairs of the batch are reduced to items as
+       columns. Entity rows of coreferent triggers are merged per event-role
+       at the end. Returns the ``ScoreAccumulator`` of every level; with
+       ``by_doc=True`` a dict of them per document id instead, without the
+       false positives.
+    '''
+    def new_scores():
+        return {level: ScoreAccumulator(compensated, keep_items) for level in levels}
+
+    totals = new_scores()
+    doc_scores = {}
+
+    def add_rows(level, rows, groups, docs):
+        if not by_doc:
+            totals[level].add_rows(rows, groups)
+            return
+        if not len(docs):
+            return
+        bounds = (np.flatnonzero(docs[1:] != docs[:-1]) + 1).tolist()
+        for lo, hi in zip([0] + bounds, bounds + [len(docs)]):
+            doc_scores[int(docs[lo])][level].add_rows(rows[lo:hi], groups[lo:hi])
+
+    with_mention = MENTION_LEVEL in levels
+    with_entity = ENTITY_COREF_LEVEL in levels
+    with_event = EVENT_COREF_LEVEL in levels
+    trigger_doc = gold.trigger_doc
+    trigger_event = gold.trigger_event
+    span_f1_matrices = interval_f1_matrices if gold.offsets else token_f1_matrices
+    # event-roles in order of appearance and the entity rows of their triggers
+    event_ids = {}
+    event_n_entities, event_role, event_doc = [], [], []
+    event_rows = []
     # for all triggers
-    scores_per_event = dict()
-    for trigger in all_triggers:
-        event_id = "-".join(trigger.split("-")[:-1])
-        event_type = all_triggers[trigger]
-        all_roles = schema[event_type]
-        for role in all_roles:
-            role = f"{event_type}.{role}"
-            id = f"{trigger}-{role}"
-            if id not in pred_id2spans:
-                if id not in label_id2spans: 
-                    continue
-                else: # false negative roles
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
-            else:
-                if id not in label_id2spans: # 1. false positive roles
-                    mention_exact_match.append(0)
-                    for key in mention_bow:
-                        mention_bow[key].append(0)
-                else:
-                    if pred_id2spans[id]["event_type"] != label_id2spans[id]["event_type"]:
-                        mention_exact_match.append(0)
-                        for key in mention_bow:
-                            mention_bow[key].append(0)
-                    else:
-                        event_role_id = f"{event_id}-{role}"
-                        if event_role_id not in scores_per_event:
-                            scores_per_event[event_role_id] = []
-                        gold_spans = [span for spans in label_id2spans[id]["spans"] for span in spans]
-                        pred_spans = pred_id2spans[id]["spans"]
-                        gold_span_idx, pairs = find_optimal_match(gold_spans, pred_spans)
-                        mention_idx_to_entity_idx = merge_entity_score(label_id2spans[id]["spans"])
-                        max_entity_score = []
-                        for i in range(len(label_id2spans[id]["spans"])):
-                            max_entity_score.append({
-                                "bow_f1": 0.0,
-                                "gold_span": None,
-                                "pred_span": None
-                            })
-                        for idx, pair in zip(gold_span_idx, pairs):
-                            p, r, f1 = compute_bow_f1(pair[0], pair[1], True)
-                            if f1 > max_entity_score[mention_idx_to_entity_idx[idx]]["bow_f1"]:
-                                max_entity_score[mention_idx_to_entity_idx[idx]] = {
-                                    "bow_f1": f1,
-                                    "gold_span": pair[0],
-                                    "pred_span": pair[1]
-                                }
-                        entity_scores_per_trigger = []
-                        for entity in max_entity_score:
-                            if entity["gold_span"] is not None:
-                                em = int(compute_exact_match(entity["gold_span"], entity["pred_span"]))
-                                p, r, f1 = compute_bow_f1(entity["gold_span"], entity["pred_span"], True)
-                            else:
-                                em = 0
-                                p, r, f1 = 0, 0, 0
-                            score = {
-                                "em": em,
-                                "bow": {
-                                    "precision": p,
-                                    "recall": r,
-                                    "f1": f1
-                                }
-                            }
-                            entity_scores_per_trigger.append(score)
-                        scores_per_event[event_role_id].append(entity_scores_per_trigger)
+    SCORING_STATS["triggers"] += len(triggers)
+    for batch in iter_batches(iter_match_cases(gold, preds, triggers), MATCH_BATCH_SIZE):
+        started = time.perf_counter()
+        problems = [([span for spans in gold_entities for span in spans], pred_spans)
+                    for _, _, gold_entities, pred_spans in batch if gold_entities is not None]
+        matrices = iter(zip(problems, span_f1_matrices(problems)))
+        assigned = time.perf_counter()
+        SCORING_STATS["matrices_seconds"] += assigned - started
+        case_role, case_doc, case_matched = [], [], []
+        pair_em, pair_precision, pair_recall, pair_f1, pair_mention = [], [], [], [], []
+        n_pairs, penalties, n_entities, mention_entities, case_event = [], [], [], [], []
+        for trigger, role, gold_entities, _ in batch:
+            doc = trigger_doc[trigger]
+            if by_doc and doc not in doc_scores:
+                doc_scores[doc] = new_scores()
+            case_role.append(role)
+            case_doc.append(doc)
+            # false negative roles, false positive roles and event type mismatches score zero
+            case_matched.append(gold_entities is not None)
+            if gold_entities is None:
+                continue
+            (gold_spans, pred_spans), (precision, recall, f1) = next(matrices)
+            gold_span_idx, col_ind = solve_assignment(f1)
+            pair_em.extend([gold_spans[i] == pred_spans[j] for i, j in zip(gold_span_idx.tolist(), col_ind.tolist())])
+            pair_precision.append(precision[gold_span_idx, col_ind])
+            pair_recall.append(recall[gold_span_idx, col_ind])
+            pair_f1.append(f1[gold_span_idx, col_ind])
+            pair_mention.append(gold_span_idx)
+            n_pairs.append(len(gold_span_idx))
+            penalties.append(min(len(gold_spans), len(pred_spans)) / max(len(gold_spans), len(pred_spans)))
+            n_entities.append(len(gold_entities))
+            mention_entities.extend([len(spans) for spans in gold_entities])
+            if with_event:
+                key = (trigger_event[trigger], role)
+                event = event_ids.get(key)
+                if event is None:
+                    event = event_ids[key] = len(event_ids)
+                    event_n_entities.append(len(gold_entities))
+                    event_role.append(role)
+                    event_doc.append(doc)
+                case_event.append(event)
 
-    # merge event-entity predictions
-    for event_role in scores_per_event:
-        all_entity_scores_for_all_triggers = scores_per_event[event_role]
-        max_all_entity_scores_per_event = copy.deepcopy(all_entity_scores_for_all_triggers[0])
-        for all_entity_scores_per_trigger in all_entity_scores_for_all_triggers:
-            for entity_idx, per_entity_scores_per_trigger in enumerate(all_entity_scores_per_trigger):
-                if per_entity_scores_per_trigger["em"] > max_all_entity_scores_per_event[entity_idx]["em"]:
-                    max_all_entity_scores_per_event[entity_idx]["em"] = per_entity_scores_per_trigger["em"]
-                if per_entity_scores_per_trigger["bow"]["f1"] > max_all_entity_scores_per_event[entity_idx]["bow"]["f1"]:
-                    max_all_entity_scores_per_event[entity_idx]["bow"]["precision"] = per_entity_scores_per_trigger["bow"]["precision"]
-                    max_all_entity_scores_per_event[entity_idx]["bow"]["recall"] = per_entity_scores_per_trigger["bow"]["recall"]
-                    max_all_entity_scores_per_event[entity_idx]["bow"]["f1"] = per_entity_scores_per_trigger["bow"]["f1"]
-        for max_per_entity_scores_per_event in max_all_entity_scores_per_event:
-            mention_exact_match.append(max_per_entity_scores_per_event["em"])
-            for key in mention_bow.keys():
-                mention_bow[key].append(max_per_entity_scores_per_event["bow"][key])
+        reduced = time.perf_counter()
+        SCORING_STATS["assignment_seconds"] += reduced - assigned
+        SCORING_STATS["cases"] += len(batch)
+        SCORING_STATS["matched_cases"] += len(problems)
+        SCORING_STATS["pairs"] += len(pair_em)
+        case_role = np.array(case_role, dtype=np.int64)
+        case_doc = np.array(case_doc, dtype=np.int64)
+        case_matched = np.array(case_matched, dtype=bool)
+        n_pairs = np.array(n_pairs, dtype=np.int64)
+        n_entities = np.array(n_entities, dtype=np.int64)
+        if problems:
+            pair_scores = np.column_stack([np.array(pair_em, dtype=np.float64), np.concatenate(pair_precision),
+                                           np.concatenate(pair_recall), np.concatenate(pair_f1)])
+        else:
+            pair_scores = np.zeros((0, 4))
+
+        def add_case_rows(level, counts, rows):
+            rows, row_counts = case_rows(case_matched, counts, rows)
+            add_rows(level, rows, np.repeat(case_role, row_counts), np.repeat(case_doc, row_counts))
+
+        if with_mention:
+            add_case_rows(MENTION_LEVEL, n_pairs, pair_scores * np.repeat(penalties, n_pairs)[:, None])
+        if with_entity or with_event:
+            # entity of the gold mention of every pair, numbering the entities and
+            # mentions of all matched cases of the batch consecutively
+            mention_entity = np.repeat(np.arange(len(mention_entities)), mention_entities)
+            n_mentions = np.array([len(gold_spans) for gold_spans, _ in problems], dtype=np.int64)
+            pair_mention = np.concatenate(pair_mention) if problems else np.zeros(0, dtype=np.int64)
+            pair_entity = mention_entity[np.repeat(np.cumsum(n_mentions) - n_mentions, n_pairs) + pair_mention]
+            entity_scores = get_entity_scores(pair_entity, pair_scores, len(mention_entities))
+            if with_entity:
+                add_case_rows(ENTITY_COREF_LEVEL, n_entities, entity_scores)
+            if with_event:
+                unmatched = ~case_matched
+                add_rows(EVENT_COREF_LEVEL, np.zeros((int(unmatched.sum()), 4)),
+                         case_role[unmatched], case_doc[unmatched])
+                entity_base = np.cumsum(n_entities) - n_entities
+                event_rows.append((np.repeat(np.array(case_event, dtype=np.int64), n_entities),
+                                   np.arange(len(entity_scores)) - np.repeat(entity_base, n_entities),
+                                   entity_scores))
+        SCORING_STATS["reduction_seconds"] += time.perf_counter() - reduced
 
+    # merge event-entity predictions
+    started = time.perf_counter()
+    if with_event and event_rows:
+        event_n_entities = np.array(event_n_entities, dtype=np.int64)
+        merged = merge_event_scores(np.concatenate([rows[0] for rows in event_rows]),
+                                    np.concatenate([rows[1] for rows in event_rows]),
+                                    np.concatenate([rows[2] for rows in event_rows]), event_n_entities)
+        add_rows(EVENT_COREF_LEVEL, merged, np.repeat(np.array(event_role, dtype=np.int64), event_n_entities),
+                 np.repeat(np.array(event_doc, dtype=np.int64), event_n_entities))
+    SCORING_STATS["event_merge_seconds"] += time.perf_counter() - started
+    if by_doc:
+        return doc_scores
     # for false positive trigger predictions
-    for id in pred_id2spans:
-        event_id = id.split("-")[1]
-        if event_id == "NA":
-            mention_exact_match.append(0)
-            for key in mention_bow:
-                mention_bow[key].append(0)
-    # average across all mentions
-    # global_em = np.mean(mention_exact_match) * 100
-    global_res = {
-        "EM": np.mean(mention_exact_match) * 100,
-        "Precision": np.mean(mention_bow["precision"]) * 100,
-        "Recall": np.mean(mention_bow["recall"]) * 100,
-        "F1": np.mean(mention_bow["f1"]) * 100
-    }
-    # print("Event-Entity Coref Leval: Exact Match: {}, Bag-of-Words F1: {}".format(global_em, global_bow))
-    return global_res
+    for level_scores in totals.values():
+        level_scores.add_zeros(n_false_positive_triggers)
+    return totals
 
-if __name__ == "__main__":
-    input_dir = argv[1]
-    output_dir = argv[2]
-    submit_dir = os.path.join(input_dir, 'res')
-    truth_dir = os.path.join(input_dir, 'ref')
-    # Create the output directory, if it does not already exist and open output files
+
+def is_false_positive_trigger(id):
+    return id.split("-")[1] == "NA"
+
+
+def group_documents(gold, preds):
+    '''Return the gold triggers and the number of false positive triggers of
+       every document, as two dicts keyed by document id in document order.
+    '''
+    doc2triggers = {}
+    for trigger in gold.gold_triggers:
+        doc2triggers.setdefault(gold.trigger_doc[trigger], []).append(trigger)
+    doc2false_positives = Counter(key[0] for key in preds.false_positives)
+    for doc in sorted(doc2false_positives):
+        doc2triggers.setdefault(doc, [])
+    return doc2triggers, doc2false_positives
+
+
+def shard_documents(gold, preds, n_shards, docs=None):
+    '''Split the documents into ``n_shards`` contiguous shards of similar size.
+       Each shard is a ``(triggers, n_false_positive_triggers)`` pair; all triggers
+       of a document, and thus of an event, fall into the same shard. With
+       ``docs`` only those documents are sharded.
+    '''
+    doc2triggers, doc2false_positives = group_documents(gold, preds)
+    if docs is not None:
+        doc2triggers = {doc: doc2triggers[doc] for doc in docs}
+    shard_size = max(1, math.ceil(sum(map(len, doc2triggers.values())) / n_shards))
+    shards = []
+    triggers, n_false_positives = [], 0
+    for doc, doc_triggers in doc2triggers.items():
+        triggers.extend(doc_triggers)
+        n_false_positives += doc2false_positives[doc]
+        if len(triggers) >= shard_size:
+            shards.append((triggers, n_false_positives))
+            triggers, n_false_positives = [], 0
+    if triggers or n_false_positives:
+        shards.append((triggers, n_false_positives))
+    return shards
+
+
+# Shards per worker process, so that uneven documents still balance out.
+SHARDS_PER_WORKER = 4
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _score_shard(shard):
+    gold, preds, levels, compensated, keep_items, by_doc = _worker_args
+    triggers, n_false_positives = shard
+    reset_scoring_stats()
+    totals = score_triggers(gold, preds, triggers, levels, n_false_positives, compensated, keep_items, by_doc)
+    return totals, Counter(ASSIGNMENT_STATS), Counter(SCORING_STATS)
+
+
+def score_level_totals(gold, preds, levels=METRIC_LEVELS, workers=1, compensated=True, keep_items=False):
+    '''Score all documents and return the ``ScoreAccumulator`` of every level.
+       With ``workers > 1`` documents are sharded across a process pool and the
+       partial accumulators are merged in document order; with compensated sums
+       the result is identical to the serial one. With ``keep_items`` the zero
+       items of false positive triggers come last, grouped under their role.
+    '''
+    n_false_positives = 0 if keep_items else len(preds.false_positives)
+    if workers <= 1:
+        totals = score_triggers(gold, preds, gold.gold_triggers, levels, n_false_positives,
+                                compensated, keep_items)
+    else:
+        shards = shard_documents(gold, preds, workers * SHARDS_PER_WORKER)
+        if keep_items:
+            shards = [(triggers, 0) for triggers, _ in shards]
+        totals = {level: ScoreAccumulator(compensated, keep_items) for level in levels}
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(gold, preds, levels, compensated, keep_items, False)) as pool:
+            for shard_totals, assignment_stats, scoring_stats in pool.imap(_score_shard, shards):
+                for level in levels:
+                    totals[level].merge(shard_totals[level])
+                ASSIGNMENT_STATS.update(assignment_stats)
+                SCORING_STATS.update(scoring_stats)
+    if keep_items:
+        for _, _, role in sorted(preds.false_positives):
+            for level_scores in totals.values():
+                level_scores.add_zeros(1, role)
+    return totals
+
+
+def compute_metrics(gold, preds, levels=METRIC_LEVELS, workers=1, compensated=True):
+    '''Return the ``global_res`` of every level for indexed gold and predictions.'''
+    totals = score_level_totals(gold, preds, levels, workers, compensated)
+    return {level: totals[level].global_res() for level in levels}
+
+
+class Scorer:
+    '''Scores in-memory predictions against gold indexed once, e.g. for
+       validation inside a training loop::
+
+           scorer = Scorer.from_files("ref/test.unified.jsonl", "ref/label2role.json")
+           metrics = scorer.score(predictions)  # {"Mention_Level": {"EM": ..., ...}, ...}
+
+       ``predictions`` is either a ``{doc id: {trigger id: pred}}`` mapping or an
+       iterable of ``{"id": doc id, "preds": {trigger id: pred}}`` documents, the
+       lines of ``test_prediction.jsonl``. Scoring does no file I/O and leaves
+       the gold index unchanged, so one scorer can serve any number of calls.
+    '''
+
+    def __init__(self, gold, levels=METRIC_LEVELS, workers=1):
+        self.gold = gold
+        self.levels = tuple(levels)
+        self.workers = workers
+
+    @classmethod
+    def from_files(cls, test_file, schema_file, ignore_non_entity=False, offsets=False, gold_cache=None,
+                   json_backend=None, **kwargs):
+        '''Build a scorer from ``test.unified.jsonl`` and ``label2role.json``, through
+           the compiled artifacts of ``gold_cache`` when given.
+        '''
+        if gold_cache:
+            gold = load_gold_cached(test_file, schema_file, gold_cache, ignore_non_entity, json_backend, offsets)
+        else:
+            with open(schema_file) as f:
+                schema = json.load(f)
+            gold = load_gold(test_file, schema, ignore_non_entity, json_backend, offsets)
+        return cls(gold, **kwargs)
+
+    @classmethod
+    def from_documents(cls, docs, schema, ignore_non_entity=False, offsets=False, **kwargs):
+        '''Build a scorer from an iterable of gold documents and the schema dict.'''
+        return cls(index_gold(docs, schema, ignore_non_entity, offsets), **kwargs)
+
+    def index(self, predictions):
+        if isinstance(predictions, dict):
+            predictions = ({"id": doc_id, "preds": preds} for doc_id, preds in predictions.items())
+        return index_predictions(predictions, self.gold)
+
+    def score(self, predictions, levels=None):
+        '''Return the ``EM``, ``Precision``, ``Recall`` and ``F1`` of every level.'''
+        return compute_metrics(self.gold, self.index(predictions), levels or self.levels, self.workers)
+
+
+def breakdown_tables(totals, gold, preds):
+    '''Break the ``keep_items`` totals of every level down by role and event type.
+       Items are reduced per role id with ``np.bincount`` and roles per event
+       type, the prefix of their ``type.role`` name. Returns ``{level: {"role":
+       rows, "event_type": rows}}``; a row holds the group name, its item count
+       and the EM/P/R/F1 mean of its items, for every group with items. The
+       zero items of predictions for ``NA`` triggers, which have no gold type,
+       count under the predicted role and its event type.
+    '''
+    extra_roles = sorted(preds._extra_roles.items(), key=lambda item: item[1])
+    role_names = [gold.roles[role] for role in range(len(gold.roles))] + [role for role, _ in extra_roles]
+    type_ids = {}
+    role_type = np.array([type_ids.setdefault(name.split(".", 1)[0], len(type_ids)) for name in role_names],
+                         dtype=np.int64)
+    type_names = list(type_ids)
+
+    def rows(names, counts, sums):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts * 100
+        return [dict([("name", names[group]), ("count", int(counts[group]))]
+                     + [(metric, float(means[k][group])) for k, metric in enumerate(ScoreAccumulator.METRICS)])
+                for group in np.flatnonzero(counts)]
+
+    tables = {}
+    for level, scores in totals.items():
+        scores._flush()
+        groups = np.frombuffer(scores.groups, dtype=np.int32)
+        if len(groups) and groups.min() < 0:
+            raise ValueError("%s has items without a role; score it with keep_items=True" % level)
+        role_counts = np.bincount(groups, minlength=len(role_names))
+        role_sums = [np.bincount(groups, weights=np.frombuffer(scores.items[metric], dtype=np.float64),
+                                 minlength=len(role_names))
+                     for metric in ScoreAccumulator.METRICS]
+        type_counts = np.bincount(role_type, weights=role_counts, minlength=len(type_names))
+        type_sums = [np.bincount(role_type, weights=sums, minlength=len(type_names)) for sums in role_sums]
+        tables[level] = {"event_type": rows(type_names, type_counts, type_sums),
+                         "role": rows(role_names, role_counts, role_sums)}
+    return tables
+
+
+def write_breakdown(output_dir, tables):
+    '''Write ``breakdown.json`` and ``breakdown.csv`` next to ``scores.txt``.'''
+    with open(os.path.join(output_dir, "breakdown.json"), "w") as f:
+        json.dump(tables, f, indent=2)
+    with open(os.path.join(output_dir, "breakdown.csv"), "w") as f:
+        f.write(",".join(("level", "group", "name", "count") + ScoreAccumulator.METRICS) + "\n")
+        for level, level_tables in tables.items():
+            for group, rows in level_tables.items():
+                for row in rows:
+                    f.write(",".join([level, group, row["name"], str(row["count"])]
+                                     + ["%0.4f" % row[metric] for metric in ScoreAccumulator.METRICS]) + "\n")
+
+
+# Bump when a change of the scoring changes the per-document aggregates.
+SCORE_CACHE_VERSION = 1
+
+
+def load_predictions_hashed(pred_path, gold, gold_version, json_backend=None):
+    '''Load predictions like ``load_predictions`` and hash them per document.
+       Returns the ``PredIndex`` and a dict of document id to the sha256 of the
+       document's ``preds`` entries, salted with ``gold_version``. Documents
+       without predictions get a hash of their own.
+    '''
+    digests = {}
+
+    def hash_docs(docs):
+        for doc in docs:
+            doc_idx = gold.docs.get(doc["id"])
+            if doc_idx is not None:
+                digest = digests.get(doc_idx)
+                if digest is None:
+                    digest = digests[doc_idx] = hashlib.sha256(
+                        f"{SCORE_CACHE_VERSION}:{gold_version}:{doc['id']}:".encode("utf-8"))
+                digest.update(json.dumps(doc["preds"], sort_keys=True).encode("utf-8"))
+                digest.update(b"\0")
+            yield doc
+
+    preds = index_predictions(hash_docs(iter_jsonl(pred_path, get_json_loads(json_backend))), gold)
+    hashes = {}
+    for doc in range(len(gold.docs)):
+        digest = digests.get(doc)
+        if digest is None:
+            digest = hashlib.sha256(f"{SCORE_CACHE_VERSION}:{gold_version}:{gold.docs[doc]}".encode("utf-8"))
+        hashes[doc] = digest.hexdigest()
+    return preds, hashes
+
+
+def load_score_cache(path):
+    '''Read the per-document aggregates written by ``save_score_cache``; a
+       missing or unreadable cache is empty.
+    '''
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != SCORE_CACHE_VERSION or cache.get("levels") != list(METRIC_LEVELS):
+        return {}
+    return cache["docs"]
+
+
+def save_score_cache(cache, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": SCORE_CACHE_VERSION, "levels": list(METRIC_LEVELS), "docs": cache}, f)
+    os.replace(tmp_path, path)
+
+
+def score_level_totals_incremental(gold, preds, doc_hashes, cache, workers=1):
+    '''Score all levels, reusing the per-document aggregates of ``cache``.
+       ``cache`` maps the ``doc_hashes`` of earlier runs to ``ScoreAccumulator``
+       states; only documents whose hash is missing are scored, sharded across
+       a process pool with ``workers > 1``. Returns the totals, the cache of
+       this run and the number of documents scored. As the aggregates are exact
+       partial sums the totals are identical to those of a full run.
+    '''
+    doc2triggers, doc2false_positives = group_documents(gold, preds)
+    stale = [doc for doc in doc2triggers if doc_hashes[doc] not in cache]
+    if workers <= 1 or len(stale) <= 1:
+        doc_scores = score_triggers(gold, preds, [trigger for doc in stale for trigger in doc2triggers[doc]],
+                                    METRIC_LEVELS, by_doc=True)
+    else:
+        doc_scores = {}
+        shards = shard_documents(gold, preds, workers * SHARDS_PER_WORKER, stale)
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(gold, preds, METRIC_LEVELS, True, False, True)) as pool:
+            for shard_scores, assignment_stats, scoring_stats in pool.imap(_score_shard, shards):
+                doc_scores.update(shard_scores)
+                ASSIGNMENT_STATS.update(assignment_stats)
+                SCORING_STATS.update(scoring_stats)
+    new_cache = {}
+    totals = {level: ScoreAccumulator() for level in METRIC_LEVELS}
+    for doc in doc2triggers:
+        key = doc_hashes[doc]
+        state = cache.get(key)
+        if state is None:
+            scores = doc_scores.get(doc) or {level: ScoreAccumulator() for level in METRIC_LEVELS}
+            state = {}
+            for level in METRIC_LEVELS:
+                scores[level].add_zeros(doc2false_positives[doc])
+                state[level] = scores[level].state()
+        new_cache[key] = state
+        for level in METRIC_LEVELS:
+            totals[level].merge(ScoreAccumulator.from_state(state[level]))
+    return totals, new_cache, len(stale)
+
+
+ItemScores = namedtuple("ItemScores", ("doc",) + ScoreAccumulator.METRICS)
+
+
+def score_items(gold, preds, levels=METRIC_LEVELS):
+    '''Return the per-item scores behind ``global_res`` as ``ItemScores`` of
+       NumPy vectors per level: the document id and EM/P/R/F1 of every item,
+       grouped by document in document order.
+    '''
+    doc2triggers, doc2false_positives = group_documents(gold, preds)
+    doc_scores = score_triggers(gold, preds, gold.gold_triggers, levels, keep_items=True, by_doc=True)
+    for doc in doc2triggers:
+        scores = doc_scores.setdefault(doc, {level: ScoreAccumulator(keep_items=True) for level in levels})
+        for level in levels:
+            scores[level].add_zeros(doc2false_positives[doc])
+    docs = list(doc2triggers)
+    items = {}
+    for level in levels:
+        accumulators = [doc_scores[doc][level] for doc in docs]
+        doc = np.repeat(np.array(docs, dtype=np.int64), [scores.count for scores in accumulators])
+        vectors = [np.concatenate([np.zeros(0)] + [np.frombuffer(scores.items[metric], dtype=np.float64)
+                                                   for scores in accumulators])
+                   for metric in ScoreAccumulator.METRICS]
+        items[level] = ItemScores(doc, *vectors)
+    return items
+
+
+def document_sums(items, n_docs):
+    '''Return the per-document EM/P/R/F1 sums, an ``(n_docs, 4)`` array, and
+       item counts of ``ItemScores``.
+    '''
+    counts = np.bincount(items.doc, minlength=n_docs).astype(np.float64)
+    sums = np.stack([np.bincount(items.doc, weights=getattr(items, metric), minlength=n_docs).astype(np.float64)
+                     for metric in ScoreAccumulator.METRICS], axis=1)
+    return sums, counts
+
+
+# Resamples drawn as one index matrix; larger requests are reduced in chunks of this size.
+RESAMPLE_BATCH_SIZE = 1024
+
+
+def resample_weights(indices, n_docs):
+    '''Count how often every document is drawn in each row of an index matrix.'''
+    offsets = np.arange(len(indices), dtype=np.int64)[:, None] * n_docs
+    return np.bincount((indices + offsets).ravel(), minlength=len(indices) * n_docs) \
+        .reshape(len(indices), n_docs).astype(np.float64)
+
+
+def weighted_scores(weights, sums, counts):
+    # scores of every row of document weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (weights @ sums) / (weights @ counts)[:, None] * 100
+
+
+def bootstrap_scores(systems, n_docs, n_resamples=1000, seed=0):
+    '''Draw document-level bootstrap resamples and score every system on them.
+       ``systems`` is a list of ``document_sums`` pairs; all systems share the
+       resamples, so differences between them are paired. Returns one
+       ``(n_resamples, 4)`` array of scores per system.
+    '''
+    rng = np.random.default_rng(seed)
+    results = [np.empty((n_resamples, len(ScoreAccumulator.METRICS))) for _ in systems]
+    for start in range(0, n_resamples, RESAMPLE_BATCH_SIZE):
+        size = min(RESAMPLE_BATCH_SIZE, n_resamples - start)
+        weights = resample_weights(rng.integers(n_docs, size=(size, n_docs)), n_docs)
+        for (sums, counts), result in zip(systems, results):
+            result[start:start + size] = weighted_scores(weights, sums, counts)
+    return results
+
+
+def permutation_deltas(system_a, system_b, n_permutations=1000, seed=0):
+    '''Score differences of A and B after swapping the predictions of a random
+       half of the documents, as an ``(n_permutations, 4)`` array.
+    '''
+    (sums_a, counts_a), (sums_b, counts_b) = system_a, system_b
+    rng = np.random.default_rng(seed)
+    deltas = np.empty((n_permutations, len(ScoreAccumulator.METRICS)))
+    for start in range(0, n_permutations, RESAMPLE_BATCH_SIZE):
+        size = min(RESAMPLE_BATCH_SIZE, n_permutations - start)
+        swap = (rng.random((size, len(counts_a))) < 0.5).astype(np.float64)
+        keep = 1.0 - swap
+        with np.errstate(invalid="ignore", divide="ignore"):
+            score_a = (keep @ sums_a + swap @ sums_b) / (keep @ counts_a + swap @ counts_b)[:, None]
+            score_b = (keep @ sums_b + swap @ sums_a) / (keep @ counts_b + swap @ counts_a)[:, None]
+        deltas[start:start + size] = (score_a - score_b) * 100
+    return deltas
+
+
+def confidence_interval(samples, confidence=0.95):
+    alpha = (1 - confidence) / 2 * 100
+    return np.nanpercentile(samples, [alpha, 100 - alpha], axis=0)
+
+
+def significance_report(gold, preds_a, preds_b=None, n_resamples=1000, confidence=0.95, seed=0):
+    '''Bootstrap confidence intervals of every level and metric of system A,
+       and with ``preds_b`` those of B, of the difference A - B and its
+       two-sided paired permutation p-value.
+    '''
+    n_docs = len(gold.docs)
+    items = [score_items(gold, preds) for preds in ((preds_a,) if preds_b is None else (preds_a, preds_b))]
+    report = {}
+    for level in METRIC_LEVELS:
+        systems = [document_sums(system_items[level], n_docs) for system_items in items]
+        scores = [weighted_scores(np.ones((1, n_docs)), sums, counts)[0] for sums, counts in systems]
+        samples = bootstrap_scores(systems, n_docs, n_resamples, seed)
+        level_report = {}
+        for name, score, system_samples in zip("AB", scores, samples):
+            low, high = confidence_interval(system_samples, confidence)
+            level_report[name] = {metric: {"score": score[k], "low": low[k], "high": high[k]}
+                                  for k, metric in enumerate(ScoreAccumulator.METRICS)}
+        if preds_b is not None:
+            delta = scores[0] - scores[1]
+            low, high = confidence_interval(samples[0] - samples[1], confidence)
+            deltas = permutation_deltas(systems[0], systems[1], n_resamples, seed)
+            # permutations at least as extreme as the observed difference, with a little float slack
+            extreme = (np.abs(deltas) >= np.abs(delta) - 1e-9).sum(axis=0)
+            p_values = (extreme + 1) / (n_resamples + 1)
+            level_report["A-B"] = {metric: {"delta": delta[k], "low": low[k], "high": high[k],
+                                            "p_value": p_values[k]}
+                                   for k, metric in enumerate(ScoreAccumulator.METRICS)}
+        report[level] = level_report
+    return report
+
+
+def score_all_levels(label_id2spans, pred_id2spans, all_triggers, schema, levels=METRIC_LEVELS, workers=1,
+                     compensated=True):
+    gold, preds = index_id2spans(label_id2spans, pred_id2spans, all_triggers, schema)
+    return compute_metrics(gold, preds, levels, workers, compensated)
+
+
+def compute_mention_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
+    return score_all_levels(label_id2spans, pred_id2spans, all_triggers, schema, levels=(MENTION_LEVEL,))[MENTION_LEVEL]
+
+
+def compute_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
+    return score_all_levels(label_id2spans, pred_id2spans, all_triggers, schema, levels=(ENTITY_COREF_LEVEL,))[ENTITY_COREF_LEVEL]
+
+
+def compute_event_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema):
+    return score_all_levels(label_id2spans, pred_id2spans, all_triggers, schema, levels=(EVENT_COREF_LEVEL,))[EVENT_COREF_LEVEL]
+
+def peak_memory_mb(who="self"):
+    '''Peak resident memory of this process, or of its largest finished child, in MB.'''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+class Profile:
+    '''Stage timings and hot-path counters of one scoring run, for ``profile.json``.
+       Stages are timed with ``stage``; the counters come from ``SCORING_STATS``
+       and ``ASSIGNMENT_STATS``, which are reset on creation. The three metric
+       levels share one scoring pass, so that pass is broken down by phase;
+       with worker processes the phase seconds are summed over the workers.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self._cache_info = tokenize_span.cache_info()
+        reset_scoring_stats()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def report(self, gold=None, preds=None, workers=1):
+        cache_info = tokenize_span.cache_info()
+        assignment = {path: ASSIGNMENT_STATS[path] for path in ASSIGNMENT_PATHS}
+        assignment["components"] = ASSIGNMENT_STATS["components"]
+        assignment["sparse"] = ASSIGNMENT_STATS["sparse"]
+        # every dense solve and every component of a decomposed matrix runs a Hungarian solver
+        assignment["hungarian_calls"] = ASSIGNMENT_STATS["dense"] + ASSIGNMENT_STATS["components"]
+        counters = {}
+        if gold is not None:
+            counters.update(documents=len(gold.docs), gold_triggers=len(gold.gold_triggers),
+                            gold_arguments=len(gold.arguments))
+        if preds is not None:
+            counters.update(predicted_arguments=len(preds.arguments),
+                            false_positive_roles=len(preds.false_positives))
+        counters.update((key, SCORING_STATS[key]) for key in ("triggers", "cases", "matched_cases", "pairs"))
+        return {
+            "stages": self.stages,
+            "scoring_phases": {key[:-len("_seconds")]: SCORING_STATS[key]
+                               for key in ("matrices_seconds", "assignment_seconds", "reduction_seconds",
+                                           "event_merge_seconds")},
+            "counters": counters,
+            "assignment": assignment,
+            "matrix_cells": matrix_size_histogram(),
+            "normalization_cache": {"hits": cache_info.hits - self._cache_info.hits,
+                                    "misses": cache_info.misses - self._cache_info.misses,
+                                    "size": cache_info.currsize, "maxsize": cache_info.maxsize},
+            "peak_memory_mb": {"self": peak_memory_mb("self"),
+                               "workers": peak_memory_mb("children") if workers > 1 else None},
+            "workers": workers,
+        }
+
+    def write(self, output_dir, gold=None, preds=None, workers=1):
+        with open(os.path.join(output_dir, "profile.json"), "w") as f:
+            json.dump(self.report(gold, preds, workers), f, indent=2)
+
+
+def write_scores(output_dir, metrics, metadata_file=None, verbose=True):
+    '''Write ``scores.txt`` and ``scores.html`` in the CodaLab format.'''
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
-    score_file = open(os.path.join(output_dir, 'scores.txt'), 'w')
-    html_file = open(os.path.join(output_dir, 'scores.html'), 'w')
-
-    # read ground truth
-    pred_path = os.path.join(submit_dir,"test_prediction.jsonl")
-    test_file = os.path.join(truth_dir,"test.unified.jsonl")
-    schema = json.load(open(os.path.join(truth_dir,"label2role.json")))
-    label_id2spans, pred_id2spans, all_triggers = get_pred_label_spans(pred_path, test_file, ignore_non_entity=False)
-    m_global_res = compute_mention_level_F1(label_id2spans, pred_id2spans, all_triggers, schema)
-    ec_global_res = compute_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema)
-    eec_global_res = compute_event_entity_coref_level_F1(label_id2spans, pred_id2spans, all_triggers, schema)
-    metrics = {
-        "Mention_Level": m_global_res,
-        "Entity_Coref_Level": ec_global_res,
-        "Event_Coref_Level": eec_global_res
-    }
-    def output_score(key, score):
-        print(key + ": %0.2f\n" % score)
-        html_file.write("======= score (" + key + ")=%0.2f =======\n" % score)
-        score_file.write(key + ": %0.2f\n" % score)
-    for l in metrics:
-        for m in metrics[l]:
-            output_score(l+"_"+m, metrics[l][m])
-
-    # Read the execution time and add it to the scores:
+    with open(os.path.join(output_dir, 'scores.txt'), 'w') as score_file, \
+            open(os.path.join(output_dir, 'scores.html'), 'w') as html_file:
+        def output_score(key, score):
+            if verbose:
+                print(key + ": %0.2f\n" % score)
+            html_file.write("======= score (" + key + ")=%0.2f =======\n" % score)
+            score_file.write(key + ": %0.2f\n" % score)
+        for l in metrics:
+            for m in metrics[l]:
+                output_score(l+"_"+m, metrics[l][m])
+
+        # Read the execution time and add it to the scores:
+        try:
+            import yaml
+            metadata = yaml.load(open(metadata_file, 'r'))
+            score_file.write("Duration: %0.2f\n" % metadata['elapsedTime'])
+        except:
+            score_file.write("Duration: 0\n")
+
+
+def load_reference(truth_dir, gold_cache=None, ignore_non_entity=False, offsets=False):
+    test_file = os.path.join(truth_dir, "test.unified.jsonl")
+    schema_file = os.path.join(truth_dir, "label2role.json")
+    if gold_cache:
+        return load_gold_cached(test_file, schema_file, gold_cache, ignore_non_entity=ignore_non_entity,
+                                offsets=offsets)
+    return load_gold(test_file, json.load(open(schema_file)), ignore_non_entity=ignore_non_entity, offsets=offsets)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score MAVEN-Arg predictions.")
+    parser.add_argument("input_dir", help="directory with the res/ (predictions) and ref/ (gold) folders")
+    parser.add_argument("output_dir", help="directory to write scores.txt and scores.html to")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to shard documents across")
+    parser.add_argument("--gold-cache", help="directory of compiled gold artifacts reused across runs")
+    parser.add_argument("--offsets", action="store_true",
+                        help="predicted arguments are [start, end] character offsets, matched by token interval overlap")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--score-cache", help="file of per-document scores; only documents whose predictions "
+                                            "changed since the last run are scored again")
+    mode.add_argument("--breakdown", action="store_true",
+                      help="also write per event type and per role scores to breakdown.json and breakdown.csv")
+    args = parser.parse_args(argv)
+    submit_dir = os.path.join(args.input_dir, 'res')
+    truth_dir = os.path.join(args.input_dir, 'ref')
+    profile = Profile()
+
+    with profile.stage("gold_load"):
+        gold = load_reference(truth_dir, args.gold_cache, offsets=args.offsets)
+    pred_path = os.path.join(submit_dir, "test_prediction.jsonl")
+    if args.score_cache:
+        with profile.stage("prediction_load"):
+            gold_version = gold_cache_key(os.path.join(truth_dir, "test.unified.jsonl"),
+                                          os.path.join(truth_dir, "label2role.json"), offsets=args.offsets)
+            preds, doc_hashes = load_predictions_hashed(pred_path, gold, gold_version)
+        with profile.stage("scoring"):
+            totals, cache, n_scored = score_level_totals_incremental(gold, preds, doc_hashes,
+                                                                     load_score_cache(args.score_cache),
+                                                                     args.workers)
+            save_score_cache(cache, args.score_cache)
+        print("Scored %d of %d documents" % (n_scored, len(cache)), file=stderr)
+        metrics = {level: totals[level].global_res() for level in METRIC_LEVELS}
+    else:
+        with profile.stage("prediction_load"):
+            preds = load_predictions(pred_path, gold)
+        with profile.stage("scoring"):
+            totals = score_level_totals(gold, preds, workers=args.workers, keep_items=args.breakdown)
+        metrics = {level: totals[level].global_res() for level in METRIC_LEVELS}
+    print(format_assignment_stats(), file=stderr)
+    with profile.stage("output"):
+        write_scores(args.output_dir, metrics, os.path.join(submit_dir, 'metadata'))
+        if args.breakdown:
+            write_breakdown(args.output_dir, breakdown_tables(totals, gold, preds))
+    profile.write(args.output_dir, gold, preds, args.workers)
+
+
+PREDICTION_FILE = "test_prediction.jsonl"
+
+
+def find_submissions(source):
+    '''Return the ``(name, prediction_file)`` pairs to score in batch mode.
+
+       ``source`` is either a directory or a manifest file. In a directory every
+       ``*.jsonl`` file is a submission named after its stem, and every
+       sub-directory holding ``test_prediction.jsonl`` (directly or under
+       ``res/``, as uploaded to CodaLab) is one named after the sub-directory.
+       A manifest lists one submission per line, either as a path or as
+       ``name<TAB>path``; relative paths are resolved against the manifest's
+       directory and blank lines and ``#`` comments are skipped.
+    '''
+    submissions = []
+    if os.path.isdir(source):
+        for entry in sorted(os.listdir(source)):
+            path = os.path.join(source, entry)
+            if os.path.isfile(path) and entry.endswith(".jsonl"):
+                submissions.append((entry[:-len(".jsonl")], path))
+            elif os.path.isdir(path):
+                for candidate in (os.path.join(path, PREDICTION_FILE), os.path.join(path, "res", PREDICTION_FILE)):
+                    if os.path.isfile(candidate):
+                        submissions.append((entry, candidate))
+                        break
+    else:
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                name, _, path = line.rpartition("\t")
+                path = os.path.join(base_dir, path.strip())
+                if not name:
+                    name = os.path.basename(path)
+                    if name == PREDICTION_FILE:
+                        name = os.path.basename(os.path.dirname(path))
+                        if name == "res":
+                            name = os.path.basename(os.path.dirname(os.path.dirname(path)))
+                    elif name.endswith(".jsonl"):
+                        name = name[:-len(".jsonl")]
+                submissions.append((name.strip(), path))
+    names = Counter(name for name, _ in submissions)
+    duplicates = sorted(name for name in names if names[name] > 1)
+    if duplicates:
+        raise ValueError("duplicate submission names: %s" % ", ".join(duplicates))
+    return submissions
+
+
+_batch_gold = None
+
+
+def _init_batch_worker(gold):
+    global _batch_gold
+    _batch_gold = gold
+
+
+def _score_submission(submission):
+    name, pred_path = submission
+    profile = Profile()
     try:
-        metadata = yaml.load(open(os.path.join(input_dir, 'res', 'metadata'), 'r'))
-        score_file.write("Duration: %0.2f\n" % metadata['elapsedTime'])
-    except:
-        score_file.write("Duration: 0\n")
-        html_file.close()
-    score_file.close()
+        with profile.stage("prediction_load"):
+            preds = load_predictions(pred_path, _batch_gold)
+        with profile.stage("scoring"):
+            metrics = compute_metrics(_batch_gold, preds)
+        return name, metrics, None, profile.report(_batch_gold, preds)
+    except Exception as e:
+        return name, None, "%s: %s" % (type(e).__name__, e), None
+
+
+def score_submissions(gold, submissions, workers=1):
+    '''Score every ``(name, prediction_file)`` against the same loaded gold.
+
+       Yields ``(name, metrics, error, profile)`` in submission order, with the
+       ``Profile`` report of the submission; a submission that fails to load
+       yields ``metrics=None`` and the error message instead of aborting the
+       whole batch. With ``workers > 1`` submissions are scored
+       concurrently, each worker receiving the gold index once.
+    '''
+    if workers <= 1 or len(submissions) <= 1:
+        _init_batch_worker(gold)
+        try:
+            for submission in submissions:
+                yield _score_submission(submission)
+        finally:
+            _init_batch_worker(None)
+        return
+    with multiprocessing.Pool(min(workers, len(submissions)), initializer=_init_batch_worker,
+                              initargs=(gold,)) as pool:
+        yield from pool.imap(_score_submission, submissions)
+
+
+def metric_columns(levels=METRIC_LEVELS):
+    return [level + "_" + metric for level in levels for metric in ScoreAccumulator.METRICS]
+
+
+def write_leaderboard(path, rows, levels=METRIC_LEVELS):
+    '''Write the combined batch table as tab-separated values, one row per submission.'''
+    columns = metric_columns(levels)
+    with open(path, "w") as f:
+        f.write("\t".join(["submission"] + columns + ["error"]) + "\n")
+        for name, metrics, error in rows:
+            if metrics is None:
+                values = ["nan"] * len(columns)
+            else:
+                values = ["%0.4f" % metrics[level][metric] for level in levels for metric in ScoreAccumulator.METRICS]
+            f.write("\t".join([name] + values + [error or ""]) + "\n")
+
+
+def batch_main(argv=None):
+    parser = argparse.ArgumentParser(prog="evaluate.py batch",
+                                     description="Score many MAVEN-Arg submissions against one gold set.")
+    parser.add_argument("ref_dir", help="directory with test.unified.jsonl and label2role.json")
+    parser.add_argument("submissions", help="directory of submissions or a manifest file listing them")
+    parser.add_argument("output_dir", help="directory to write leaderboard.tsv and one scores folder per submission to")
+    parser.add_argument("--workers", type=int, default=1, help="number of submissions to score concurrently")
+    parser.add_argument("--gold-cache", help="directory of compiled gold artifacts reused across runs")
+    parser.add_argument("--offsets", action="store_true",
+                        help="predicted arguments are [start, end] character offsets, matched by token interval overlap")
+    args = parser.parse_args(argv)
+
+    submissions = find_submissions(args.submissions)
+    started = time.perf_counter()
+    gold = load_reference(args.ref_dir, args.gold_cache, offsets=args.offsets)
+    gold_load = time.perf_counter() - started
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    pred_paths = dict(submissions)
+    rows = []
+    for name, metrics, error, profile in score_submissions(gold, submissions, args.workers):
+        if error is not None:
+            print("%s: %s" % (name, error), file=stderr)
+        else:
+            output_dir = os.path.join(args.output_dir, name)
+            started = time.perf_counter()
+            write_scores(output_dir, metrics, os.path.join(os.path.dirname(pred_paths[name]), 'metadata'),
+                         verbose=False)
+            # the gold set is loaded once and shared by all submissions
+            profile["stages"] = dict(gold_load=gold_load, **profile["stages"],
+                                     output=time.perf_counter() - started)
+            with open(os.path.join(output_dir, "profile.json"), "w") as f:
+                json.dump(profile, f, indent=2)
+        rows.append((name, metrics, error))
+    write_leaderboard(os.path.join(args.output_dir, "leaderboard.tsv"), rows)
+    print("scored %d/%d submissions" % (sum(error is None for _, _, error in rows), len(rows)), file=stderr)
+    return 1 if any(error is not None for _, _, error in rows) else 0
+
+
+def significance_main(argv=None):
+    parser = argparse.ArgumentParser(prog="evaluate.py significance",
+                                     description="Bootstrap confidence intervals of a MAVEN-Arg submission, "
+                                                 "or a paired comparison of two.")
+    parser.add_argument("ref_dir", help="directory with test.unified.jsonl and label2role.json")
+    parser.add_argument("predictions", nargs="+", help="one or two prediction files (system A, system B)")
+    parser.add_argument("--resamples", type=int, default=1000, help="number of bootstrap resamples and permutations")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gold-cache", help="directory of compiled gold artifacts reused across runs")
+    parser.add_argument("--offsets", action="store_true",
+                        help="predicted arguments are [start, end] character offsets, matched by token interval overlap")
+    args = parser.parse_args(argv)
+    if len(args.predictions) > 2:
+        parser.error("at most two prediction files can be compared")
+
+    gold = load_reference(args.ref_dir, args.gold_cache, offsets=args.offsets)
+    preds = [load_predictions(path, gold) for path in args.predictions]
+    report = significance_report(gold, *preds, n_resamples=args.resamples, confidence=args.confidence,
+                                 seed=args.seed)
+    print(json.dumps(report, indent=2, default=float))
+
+
+COMMANDS = {"batch": batch_main, "significance": significance_main}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+    main()
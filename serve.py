@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+'''Long-running local scoring service for MAVEN-Arg submissions.
+
+Gold data (``test.unified.jsonl`` and ``label2role.json``) is indexed once at
+startup and handed to a pool of worker processes. Uploads are then scored at
+the cost of reading and scoring the predictions alone::
+
+    python serve.py REF_DIR --port 8008 --workers 4
+    python serve.py REF_DIR --socket /tmp/maven-arg.sock
+
+    curl -sS --data-binary @test_prediction.jsonl http://127.0.0.1:8008/score
+    curl -sS -X POST -T test_prediction.jsonl -H "Transfer-Encoding: chunked" http://127.0.0.1:8008/score
+    curl -sS --unix-socket /tmp/maven-arg.sock http://localhost/stats
+
+Endpoints:
+
+``POST /score``
+    The body is a ``test_prediction.jsonl`` upload, sent with a
+    ``Content-Length`` or streamed with chunked transfer encoding. The reply
+    holds the ``Mention_Level``, ``Entity_Coref_Level`` and
+    ``Event_Coref_Level`` metrics and the latency of each step. A submission
+    that fails to parse gets a 400, and one larger than ``--max-upload-mb``
+    gets a 413.
+``GET /stats``
+    Queue depth, counters and latency percentiles over recent submissions.
+``GET /health``
+    Liveness probe.
+
+At most ``--workers + --queue-size`` submissions are admitted at a time.
+Admitted uploads are still being received, waiting in the queue or being
+scored. Further requests are refused with 503 and ``Retry-After`` before
+their body is read, which pushes back on clients instead of letting the
+queue grow. Bodies are spooled to a temporary file as they arrive and the
+worker parses that file one line at a time. Disk use therefore stays below
+the admitted uploads times ``--max-upload-mb``, and the memory of a worker
+is the indexed predictions of one submission.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import socketserver
+import multiprocessing
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import evaluate
+
+
+# Latencies of this many recent submissions are kept for ``/stats``.
+LATENCY_WINDOW = 1024
+LATENCY_STAGES = ("receive", "queue", "scoring", "total")
+LATENCY_PERCENTILES = (50, 90, 99)
+READ_SIZE = 1 << 16
+
+
+def _init_worker(gold):
+    global _gold, _loads
+    _gold = gold
+    _loads = evaluate.get_json_loads()
+
+
+def _score_upload(path):
+    '''Score one spooled JSONL upload against the worker's gold; also returns
+       when scoring started and finished, so that the time spent queued is known.
+    '''
+    started = time.time()
+    try:
+        metrics = evaluate.compute_metrics(_gold, evaluate.index_predictions(evaluate.iter_jsonl(path, _loads), _gold))
+        error = None
+    except Exception as e:
+        metrics, error = None, "%s: %s" % (type(e).__name__, e)
+    return metrics, error, started, time.time()
+
+
+def latency_summary(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    summary = {"count": len(values), "mean": sum(values) / len(values)}
+    for percentile in LATENCY_PERCENTILES:
+        summary["p%d" % percentile] = values[min(len(values) - 1, len(values) * percentile // 100)]
+    summary["max"] = values[-1]
+    return summary
+
+
+class ScoringService:
+    '''Gold loaded once, the worker pool scoring uploads against it, admission
+       control and the bookkeeping behind ``/stats``.
+    '''
+
+    def __init__(self, gold, workers=1, queue_size=8, max_upload=256 << 20, spool_dir=None):
+        self.gold = gold
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.max_upload = max_upload
+        self.spool_dir = tempfile.mkdtemp(prefix="maven-arg-uploads-", dir=spool_dir)
+        self.pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(gold,))
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.pending = 0
+        self.counts = Counter()
+        self.latencies = {stage: deque(maxlen=LATENCY_WINDOW) for stage in LATENCY_STAGES}
+        self.started = time.time()
+
+    def admit(self):
+        '''Reserve a slot for one submission; ``False`` when the service is full.'''
+        with self.lock:
+            if self.admitted >= self.capacity:
+                self.counts["rejected"] += 1
+                return False
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.admitted -= 1
+
+    def spool(self):
+        return tempfile.NamedTemporaryFile("wb", suffix=".jsonl", dir=self.spool_dir, delete=False)
+
+    def score(self, path, received, submitted):
+        '''Score an admitted upload spooled to ``path``; ``received`` is when its
+           request arrived and ``submitted`` when its body had been read.
+        '''
+        with self.lock:
+            self.pending += 1
+        try:
+            metrics, error, started, finished = self.pool.apply(_score_upload, (path,))
+        finally:
+            with self.lock:
+                self.pending -= 1
+        latency = {"receive": submitted - received, "queue": max(0.0, started - submitted),
+                   "scoring": finished - started, "total": time.time() - received}
+        with self.lock:
+            if error is None:
+                self.counts["scored"] += 1
+                for stage, seconds in latency.items():
+                    self.latencies[stage].append(seconds)
+            else:
+                self.counts["errors"] += 1
+        return metrics, error, latency
+
+    def stats(self):
+        with self.lock:
+            running = min(self.pending, self.workers)
+            return {
+                "uptime": time.time() - self.started,
+                "gold": {"docs": len(self.gold.docs), "triggers": len(self.gold.gold_triggers)},
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "admitted": self.admitted,
+                "receiving": self.admitted - self.pending,
+                "running": running,
+                "queue_depth": self.pending - running,
+                "scored": self.counts["scored"],
+                "errors": self.counts["errors"],
+                "rejected": self.counts["rejected"],
+                "latency": {stage: latency_summary(values) for stage, values in self.latencies.items()},
+            }
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, code, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def copy_body(self, out, size):
+        while size > 0:
+            part = self.rfile.read(min(size, READ_SIZE))
+            if not part:
+                raise ValueError("connection closed before the end of the body")
+            out.write(part)
+            size -= len(part)
+
+    def spool_body(self, out, limit):
+        '''Copy the request body, plain or chunked, to the file ``out``, failing
+           as soon as it exceeds ``limit`` bytes.
+        '''
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            size = 0
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";", 1)[0].strip(), 16)
+                if chunk_size == 0:
+                    while self.rfile.readline().strip():  # trailers
+                        pass
+                    break
+                size += chunk_size
+                if size > limit:
+                    raise UploadTooLarge(size)
+                self.copy_body(out, chunk_size)
+                self.rfile.readline()
+        else:
+            size = int(self.headers.get("Content-Length", 0))
+            if size > limit:
+                raise UploadTooLarge(size)
+            self.copy_body(out, size)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.service.stats())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        received = time.time()
+        if self.path != "/score":
+            self.close_connection = True
+            self.send_json(404, {"error": "unknown path " + self.path})
+            return
+        if not service.admit():
+            # the body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            self.send_json(503, {"error": "scoring queue is full"}, [("Retry-After", "1")])
+            return
+        upload = service.spool()
+        try:
+            try:
+                with upload:
+                    self.spool_body(upload, service.max_upload)
+            except UploadTooLarge as e:
+                self.close_connection = True
+                code, reply = 413, {"error": "upload of %s bytes exceeds the limit of %d" % (e, service.max_upload)}
+            except ValueError as e:
+                self.close_connection = True
+                code, reply = 400, {"error": "malformed request body: %s" % e}
+            else:
+                metrics, error, latency = service.score(upload.name, received, time.time())
+                if error is not None:
+                    code, reply = 400, {"error": error, "latency": latency}
+                else:
+                    code, reply = 200, {"metrics": metrics, "latency": latency}
+        finally:
+            # free the upload and its slot before answering, so that a client
+            # may follow up at once
+            os.unlink(upload.name)
+            service.release()
+        self.send_json(code, reply)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8008, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, ScoringRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve MAVEN-Arg scoring over HTTP with the gold data preloaded.")
+    parser.add_argument("ref_dir", help="directory with test.unified.jsonl and label2role.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=1, help="number of submissions scored concurrently")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="submissions admitted beyond the busy workers before new ones are refused with 503")
+    parser.add_argument("--max-upload-mb", type=float, default=256, help="largest accepted upload")
+    parser.add_argument("--spool-dir", help="directory to spool uploads to while they wait (default: the temp dir)")
+    parser.add_argument("--gold-cache", help="directory of compiled gold artifacts reused across runs")
+    parser.add_argument("--offsets", action="store_true",
+                        help="predicted arguments are [start, end] character offsets, matched by token interval overlap")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.queue_size < 0:
+        parser.error("--workers must be positive and --queue-size non-negative")
+
+    started = time.perf_counter()
+    gold = evaluate.load_reference(args.ref_dir, args.gold_cache, offsets=args.offsets)
+    service = ScoringService(gold, args.workers, args.queue_size, int(args.max_upload_mb * (1 << 20)), args.spool_dir)
+    if args.quiet:
+        ScoringRequestHandler.log_message = lambda *_: None
+    server = make_server(service, args.host, args.port, args.socket)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    address = args.socket or "http://%s:%d" % server.server_address[:2]
+    print("Loaded %d documents in %.2fs; serving on %s with %d workers"
+          % (len(gold.docs), time.perf_counter() - started, address, args.workers), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
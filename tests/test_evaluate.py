@@ -0,0 +1,367 @@
+import os
+import json
+
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+import evaluate
+
+
+TEXT = "alpha beta gamma delta epsilon zeta"
+SCHEMA = {"Attack": ["Agent"]}
+
+
+def document(doc_id, *events):
+    '''A gold document and its predictions with one trigger per event. Each
+       event is ``(event type, role, entities, predicted)``: the gold entities
+       of the role as lists of mention strings of ``TEXT`` and the predicted
+       strings of the role, or ``None`` when the trigger has no prediction.
+    '''
+    gold = {"id": doc_id, "text": TEXT, "negative_triggers": [], "events": []}
+    preds = {"id": doc_id, "preds": {}}
+    for event_idx, (event_type, role, entities, predicted) in enumerate(events):
+        trigger_id = f"{doc_id}-trigger{event_idx}"
+        gold["events"].append({"id": f"event{event_idx}", "type": event_type, "triggers": [{
+            "id": trigger_id, "arguments": [{
+                "id": f"entity{entity_idx}", "role": f"{event_type}.{role}",
+                "mentions": [{"position": [TEXT.index(mention), TEXT.index(mention) + len(mention)]}
+                             for mention in mentions]}
+                for entity_idx, mentions in enumerate(entities)]}]})
+        if predicted is not None:
+            preds["preds"][trigger_id] = {"event_type": event_type, role: predicted}
+    return gold, preds
+
+
+def write_dataset(tmp_path, mentions, predicted):
+    '''One document, one trigger and a single ``Attack.Agent`` entity with
+       ``mentions``; the prediction of that role lists the ``predicted`` strings.
+    '''
+    positions = [[TEXT.index(word), TEXT.index(word) + len(word)] for word in mentions]
+    gold = {"id": "doc", "text": TEXT, "negative_triggers": [], "events": [{
+        "id": "event", "type": "Attack", "triggers": [{
+            "id": "trigger", "arguments": [{
+                "id": "entity", "role": "Attack.Agent",
+                "mentions": [{"position": position} for position in positions]}]}]}]}
+    preds = {"id": "doc", "preds": {"trigger": {"event_type": "Attack", "Agent": predicted}}}
+    test_file = tmp_path / "test.unified.jsonl"
+    pred_file = tmp_path / "test_prediction.jsonl"
+    test_file.write_text(json.dumps(gold) + "\n")
+    pred_file.write_text(json.dumps(preds) + "\n")
+    return evaluate.get_pred_label_spans(str(pred_file), str(test_file)) + (SCHEMA,)
+
+
+def test_batch_without_overlapping_cells(tmp_path):
+    # a matrix above SCALAR_MATRIX_CELLS in which no gold and pred span share a token
+    inputs = write_dataset(tmp_path, ["alpha", "beta", "gamma"], ["delta", "epsilon", "zeta"])
+    zeros = {"EM": 0.0, "Precision": 0.0, "Recall": 0.0, "F1": 0.0}
+    assert evaluate.compute_mention_level_F1(*inputs) == zeros
+    assert evaluate.compute_entity_coref_level_F1(*inputs) == zeros
+    assert evaluate.compute_event_entity_coref_level_F1(*inputs) == zeros
+
+
+def tied_sparse_scores(seed, shape=(80, 90), density=0.05):
+    # few distinct values, as for roles with many repeated surface strings
+    rnd = np.random.default_rng(seed)
+    scores = rnd.choice([0.5, 2 / 3, 1.0], size=shape)
+    scores[rnd.random(shape) >= density] = 0.0
+    return scores
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_large_sparse_assignment_matches_linear_sum_assignment(seed):
+    scores = tied_sparse_scores(seed)
+    assert scores.size >= evaluate.SPARSE_MIN_CELLS
+    row_ind, col_ind = evaluate.solve_assignment(scores)
+    expected_rows, expected_cols = linear_sum_assignment(-scores)
+    np.testing.assert_array_equal(row_ind, expected_rows)
+    np.testing.assert_array_equal(col_ind, expected_cols)
+
+
+def test_sparse_assignment_is_opt_in_and_optimal(monkeypatch):
+    scores = tied_sparse_scores(0)
+    evaluate.reset_assignment_stats()
+    evaluate.solve_assignment(scores)
+    assert evaluate.ASSIGNMENT_STATS["decomposed"] == 0
+    monkeypatch.setattr(evaluate, "SPARSE_ASSIGNMENT", True)
+    row_ind, col_ind = evaluate.solve_assignment(scores)
+    assert evaluate.ASSIGNMENT_STATS["decomposed"] == 1
+    expected_rows, expected_cols = linear_sum_assignment(-scores)
+    assert scores[row_ind, col_ind].sum() == pytest.approx(scores[expected_rows, expected_cols].sum())
+
+
+def write_reference(ref_dir, mentions):
+    ref_dir.mkdir()
+    write_dataset(ref_dir, mentions, [])
+    (ref_dir / "label2role.json").write_text(json.dumps(SCHEMA))
+    return str(ref_dir / "test.unified.jsonl"), str(ref_dir / "label2role.json")
+
+
+def test_gold_cache_shared_by_reference_sets_and_modes(tmp_path, monkeypatch):
+    builds = []
+    load_gold = evaluate.load_gold
+    monkeypatch.setattr(evaluate, "load_gold", lambda *args: builds.append(args[0]) or load_gold(*args))
+    first = write_reference(tmp_path / "first", ["alpha"])
+    second = write_reference(tmp_path / "second", ["beta"])
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(3):
+        for files in (first, second):
+            for offsets in (False, True):
+                evaluate.load_gold_cached(*files, cache_dir, offsets=offsets)
+    assert len(builds) == 4
+    assert len(os.listdir(cache_dir)) == 4
+
+    # a changed reference replaces only its own artifact of the same mode
+    write_dataset(tmp_path / "first", ["gamma"], [])
+    evaluate.load_gold_cached(*first, cache_dir)
+    assert len(builds) == 5
+    assert len(os.listdir(cache_dir)) == 4
+
+
+@pytest.mark.parametrize("size", [4, 12, 40, -1])
+def test_truncated_gold_artifact_is_rebuilt(tmp_path, monkeypatch, size):
+    # cut in the magic, the header length, the header and the last blob
+    files = write_reference(tmp_path / "ref", ["alpha beta"])
+    cache_dir = tmp_path / "cache"
+    expected = evaluate.load_gold_cached(*files, str(cache_dir))
+    artifact, = cache_dir.iterdir()
+    artifact.write_bytes(artifact.read_bytes()[:size])
+    with pytest.raises(ValueError):
+        evaluate.load_gold_artifact(str(artifact))
+    builds = []
+    load_gold = evaluate.load_gold
+    monkeypatch.setattr(evaluate, "load_gold", lambda *args: builds.append(args[0]) or load_gold(*args))
+    gold = evaluate.load_gold_cached(*files, str(cache_dir))
+    assert len(builds) == 1
+    assert dict(gold.arguments) == dict(expected.arguments)
+    assert isinstance(evaluate.load_gold_artifact(str(artifact)), evaluate.MappedGoldIndex)
+
+
+def test_incremental_scoring_with_workers_matches_full_run(tmp_path):
+    words = TEXT.split()
+    gold_docs, pred_docs = [], []
+    for doc_idx in range(6):
+        arguments = [{"id": f"entity{i}", "role": "Attack.Agent",
+                      "mentions": [{"position": [TEXT.index(word), TEXT.index(word) + len(word)]}]}
+                     for i, word in enumerate(words[doc_idx % 3:doc_idx % 3 + 3])]
+        gold_docs.append({"id": f"doc{doc_idx}", "text": TEXT, "negative_triggers": [], "events": [{
+            "id": "event", "type": "Attack", "triggers": [
+                {"id": f"doc{doc_idx}-trigger{i}", "arguments": arguments} for i in range(2)]}]})
+        pred_docs.append({"id": f"doc{doc_idx}", "preds": {
+            f"doc{doc_idx}-trigger0": {"event_type": "Attack", "Agent": words[doc_idx:doc_idx + 2]}}})
+    # a fully matched document and one without predictions
+    for gold_doc, pred_doc in (document("matched", ("Attack", "Agent", [["alpha"], ["beta"]], ["alpha", "beta"])),
+                               document("unpredicted", ("Attack", "Agent", [["gamma"]], None))):
+        gold_docs.append(gold_doc)
+        pred_docs.append(pred_doc)
+    pred_file = tmp_path / "test_prediction.jsonl"
+    pred_file.write_text("".join(json.dumps(doc) + "\n" for doc in pred_docs))
+    gold = evaluate.index_gold(gold_docs, SCHEMA)
+    preds, doc_hashes = evaluate.load_predictions_hashed(str(pred_file), gold, "gold")
+    expected = evaluate.compute_metrics(gold, preds)
+
+    serial = evaluate.score_level_totals_incremental(gold, preds, doc_hashes, {})
+    assert {level: serial[0][level].global_res() for level in serial[0]} == expected
+    partial_cache = dict(list(serial[1].items())[::2])
+    for cache in ({}, partial_cache):
+        totals, new_cache, _ = evaluate.score_level_totals_incremental(gold, preds, doc_hashes, cache, workers=2)
+        assert {level: totals[level].global_res() for level in totals} == expected
+        assert new_cache == serial[1]
+
+
+def test_scoring_service_spools_uploads(tmp_path, monkeypatch):
+    import http.client
+    import threading
+
+    import serve
+
+    inputs_dir = tmp_path / "data"
+    inputs_dir.mkdir()
+    write_dataset(inputs_dir, ["alpha beta", "gamma"], ["alpha", "delta"])
+    gold = evaluate.load_gold(str(inputs_dir / "test.unified.jsonl"), SCHEMA)
+    upload = (inputs_dir / "test_prediction.jsonl").read_bytes()
+    expected = evaluate.Scorer(gold).score([json.loads(upload)])
+
+    service = serve.ScoringService(gold, workers=1, queue_size=0, max_upload=len(upload), spool_dir=str(tmp_path))
+    monkeypatch.setattr(serve.ScoringRequestHandler, "log_message", lambda *_: None)
+    server = serve.make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        def post(body, **kwargs):
+            connection = http.client.HTTPConnection(*server.server_address, timeout=60)
+            connection.request("POST", "/score", body=body, **kwargs)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+
+        status, reply = post(upload)
+        assert status == 200 and reply["metrics"] == expected
+        status, reply = post(iter([upload[:10], upload[10:]]), encode_chunked=True)
+        assert status == 200 and reply["metrics"] == expected
+        assert post(upload + b"\n")[0] == 413
+        assert os.listdir(service.spool_dir) == []
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+        thread.join()
+    assert not os.path.exists(service.spool_dir)
+
+
+@pytest.mark.parametrize("predicted", [["alpha", "beta gamma"], None], ids=["all-matched", "no-prediction"])
+def test_score_triggers_by_doc_with_empty_row_blocks(predicted):
+    # every case of the batch matched (no zero rows), or none (no event rows)
+    gold_doc, pred_doc = document("doc", ("Attack", "Agent", [["alpha"], ["beta gamma"]], predicted))
+    gold = evaluate.index_gold([gold_doc], SCHEMA)
+    preds = evaluate.index_predictions([pred_doc], gold)
+    totals = evaluate.score_triggers(gold, preds, gold.gold_triggers)
+    doc_scores = evaluate.score_triggers(gold, preds, gold.gold_triggers, by_doc=True)
+    assert list(doc_scores) == [0]
+    for level in evaluate.METRIC_LEVELS:
+        assert doc_scores[0][level].global_res() == totals[level].global_res()
+
+
+
+def index_documents(documents, schema=SCHEMA):
+    gold = evaluate.index_gold([gold_doc for gold_doc, _ in documents], schema)
+    return gold, evaluate.index_predictions([pred_doc for _, pred_doc in documents], gold)
+
+
+# (document id, gold entities of Attack.Agent, predicted strings)
+SYSTEM_CASES = [
+    ("partial", [["alpha beta"], ["gamma"]], ["alpha", "delta"]),
+    ("matched", [["beta"]], ["beta"]),
+    ("unpredicted", [["gamma"]], None),
+    ("false-positive", [], ["zeta"]),
+]
+
+
+def system_documents(perfect=False):
+    return [document(doc_id, ("Attack", "Agent", entities,
+                              ([entity[0] for entity in entities] or None) if perfect else predicted))
+            for doc_id, entities, predicted in SYSTEM_CASES]
+
+
+def test_item_scores_average_to_metrics():
+    gold, preds = index_documents(system_documents())
+    expected = evaluate.compute_metrics(gold, preds)
+    items = evaluate.score_items(gold, preds)
+    for level in evaluate.METRIC_LEVELS:
+        for metric in evaluate.ScoreAccumulator.METRICS:
+            assert getattr(items[level], metric).mean() * 100 == pytest.approx(expected[level][metric])
+
+
+def test_significance_report_of_two_systems():
+    gold, preds_a = index_documents(system_documents())
+    preds_b = index_documents(system_documents(perfect=True))[1]
+    expected = evaluate.compute_metrics(gold, preds_a)
+    report = evaluate.significance_report(gold, preds_a, preds_b, n_resamples=50)
+    assert set(report) == set(evaluate.METRIC_LEVELS)
+    for level, level_report in report.items():
+        assert set(level_report) == {"A", "B", "A-B"}
+        for metric, score in level_report["A"].items():
+            assert score["score"] == pytest.approx(expected[level][metric])
+            assert score["low"] <= score["high"]
+        assert all(score["score"] == 100 for score in level_report["B"].values())
+        for metric, delta in level_report["A-B"].items():
+            assert delta["delta"] == pytest.approx(expected[level][metric] - 100)
+            assert 0 < delta["p_value"] <= 1
+
+
+def index_offsets(predicted):
+    # gold "alpha beta gamma" is the token interval (0, 3) of TEXT
+    gold_doc, pred_doc = document("doc", ("Attack", "Agent", [["alpha beta gamma"]], predicted))
+    gold = evaluate.index_gold([gold_doc], SCHEMA, offsets=True)
+    return gold, evaluate.index_predictions([pred_doc], gold)
+
+
+@pytest.mark.parametrize("span, interval, scores", [
+    ([0, 16], (0, 3), (100, 100, 100, 100)),
+    # "beta gamma delta": 2 of 3 tokens on either side
+    ([6, 22], (1, 4), (0, 200 / 3, 200 / 3, 200 / 3)),
+    # "ta gam" lies inside "beta" and "gamma" and covers both tokens
+    ([8, 13], (1, 3), (0, 100, 200 / 3, 80)),
+    ([31, 35], (5, 6), (0, 0, 0, 0)),
+])
+def test_offset_interval_scores(span, interval, scores):
+    gold, preds = index_offsets([span])
+    assert gold.arguments[(0, 0)] == [[(0, 3)]]
+    assert preds.arguments[(0, 0)][1] == [interval]
+    metrics = evaluate.compute_metrics(gold, preds)[evaluate.MENTION_LEVEL]
+    assert [metrics[metric] for metric in evaluate.ScoreAccumulator.METRICS] == pytest.approx(scores)
+
+
+@pytest.mark.parametrize("span", [[5], [0, "5"], "alpha", [-1, 5], [10, 5], [30, 36]])
+def test_malformed_or_out_of_range_offsets(span):
+    with pytest.raises(ValueError):
+        index_offsets([span])
+
+
+TYPED_SCHEMA = {"Attack": ["Agent", "Target"], "Meet": ["Place"]}
+# the events of documents "a" and "b" per event type
+TYPED_EVENTS = {
+    "Attack": [("Attack", "Agent", [["alpha"]], ["alpha", "beta"]), ("Attack", "Target", [["epsilon"]], None)],
+    "Meet": [("Meet", "Place", [["gamma delta"]], ["delta"]), ("Meet", "Place", [["zeta"]], ["zeta"])],
+}
+
+
+def typed_documents(event_types):
+    return [document(doc_id, *[TYPED_EVENTS[event_type][doc_idx] for event_type in event_types])
+            for doc_idx, doc_id in enumerate("ab")]
+
+
+def breakdown_of(documents):
+    gold, preds = index_documents(documents, TYPED_SCHEMA)
+    totals = evaluate.score_level_totals(gold, preds, keep_items=True)
+    return totals, evaluate.breakdown_tables(totals, gold, preds)
+
+
+def score_sums(rows):
+    return {metric: sum(row["count"] * row[metric] for row in rows) for metric in evaluate.ScoreAccumulator.METRICS}
+
+
+def test_breakdown_by_event_type_and_role(tmp_path):
+    totals, tables = breakdown_of(typed_documents(["Attack", "Meet"]))
+    for level, level_tables in tables.items():
+        # count-weighted means of the roles and of the types add up to the global scores
+        for group in ("role", "event_type"):
+            assert sum(row["count"] for row in level_tables[group]) == totals[level].count
+            for metric, total in score_sums(level_tables[group]).items():
+                assert total / totals[level].count == pytest.approx(totals[level].global_res()[metric])
+        assert [row["name"] for row in level_tables["role"]] == ["Attack.Agent", "Attack.Target", "Meet.Place"]
+        # a type row scores like the documents reduced to the events of that type
+        for row in level_tables["event_type"]:
+            type_totals = breakdown_of(typed_documents([row["name"]]))[0][level]
+            assert row["count"] == type_totals.count
+            for metric, score in type_totals.global_res().items():
+                assert row[metric] == pytest.approx(score)
+
+    evaluate.write_breakdown(str(tmp_path), tables)
+    assert json.loads((tmp_path / "breakdown.json").read_text()) == tables
+    lines = (tmp_path / "breakdown.csv").read_text().splitlines()
+    assert lines[0] == "level,group,name,count,EM,Precision,Recall,F1"
+    assert len(lines) == 1 + sum(len(rows) for level_tables in tables.values() for rows in level_tables.values())
+
+
+def with_na_prediction(documents):
+    # a Meet.Place prediction for a negative trigger of "b", one zero item
+    gold_doc, pred_doc = documents[1]
+    gold_doc["negative_triggers"].append({"id": "b-negative"})
+    pred_doc["preds"]["b-negative"] = {"event_type": "Meet", "Place": ["epsilon"]}
+    return documents
+
+
+def test_breakdown_counts_na_false_positives_under_the_predicted_type():
+    # NA triggers have no gold type, so their items count under the predicted
+    # role: a type row scores like the documents reduced to the gold events of
+    # that type and the NA predictions of that type
+    _, tables = breakdown_of(with_na_prediction(typed_documents(["Attack", "Meet"])))
+    expected = {"Attack": breakdown_of(typed_documents(["Attack"]))[0],
+                "Meet": breakdown_of(with_na_prediction(typed_documents(["Meet"])))[0]}
+    for level, level_tables in tables.items():
+        for row in level_tables["event_type"]:
+            type_totals = expected[row["name"]][level]
+            assert row["count"] == type_totals.count
+            for metric, score in type_totals.global_res().items():
+                assert row[metric] == pytest.approx(score)
+        assert {row["name"]: row["count"] for row in level_tables["role"]}["Meet.Place"] == 3